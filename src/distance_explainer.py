@@ -1,11 +1,27 @@
 """Documentation about distance_explainer."""
 
+import asyncio
+import collections
+import contextlib
+import functools
+import hashlib
+import itertools
+import json
 import logging
+import mmap
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 import dianna.utils
 import numpy as np
 import numpy.typing
 from dianna.utils.maskers import generate_interpolated_float_masks_for_image
-from sklearn.metrics import pairwise_distances
 from tqdm import tqdm
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
@@ -23,33 +39,125 @@ class DistanceExplainer:
     def __init__(self, n_masks=1000, feature_res=8, p_keep=.5,  # pylint: disable=too-many-arguments
                  mask_selection_range_max=0.2, mask_selection_range_min=0, mask_selection_negative_range_max=1,
                  mask_selection_negative_range_min=0.8, axis_labels=None, batch_size=10,
-                 preprocess_function=None):
+                 preprocess_function=None, n_workers=1, backend='thread', seed=None, mask_bank=None,
+                 mask_cache=None, weighted_selection=False, convergence_threshold=None, convergence_interval=100,
+                 embedding_cache=None, max_batch_bytes=2 ** 28, prefetch=False, dtype=None,
+                 distance_metric='cosine', keep_predictions=True, scratch_dir=None):
         """Creates an explainer object to explain an image with respect to a reference point in an embedded space.
 
         Args:
             n_masks: Number of masks to use to mask the input image. More increases reliability and computation.
             feature_res: Number of features per dimension in the image. Determines the super pixel size in the masks.
             p_keep: Probability of keeping features unmasked. Higher means less masked input.
-            batch_size: Number of masked inputs to process in a single batch by the model
+            batch_size: Number of masked inputs to process in a single batch by the model. With 'auto', the batch size
+                        with the highest throughput is found by running the model on a few batches of increasing size,
+                        the first time an image of a new shape is explained.
             axis_labels: Axis labels
             preprocess_function: Preprocess function
             mask_selection_range_max: Top end of range of outcomes that will be selected.
             mask_selection_range_min: Lower end of range of outcomes that will be selected.
             mask_selection_negative_range_max: Top end of range of outcomes that will be selected and weighted -1.
             mask_selection_negative_range_min: Lower end of range of outcomes that will be selected and weighted -1.
+            n_workers: Number of workers that run batches through the model concurrently.
+            backend: How workers are run if n_workers > 1. 'thread' only speeds up models that release the GIL, like
+                     ONNX models or remote embedding services. 'process' also speeds up pure Python models, but
+                     requires the model and preprocess_function to be picklable.
+            seed: Seed (int) or numpy.random.Generator for generating masks. If given, masks are generated with the
+                  vectorized generate_interpolated_float_masks. If None, dianna's mask generator is used, which
+                  draws from numpy's global random state.
+            mask_bank: MaskBank, or path to its directory, to store generated masks in and to memory-map them from
+                       on later runs. Requires an integer seed.
+            mask_cache: MaskCache to keep generated masks in memory for later calls, possibly shared between explainers.
+                        Requires an integer seed.
+            weighted_selection: If True, selected masks are weighted by exp(-distance) in the attribution map, instead
+                                of all selected masks having equal weight.
+            convergence_threshold: If given, explain_image_distance stops using more masks once the correlation
+                                   between successive attribution maps reaches this threshold. The number of masks
+                                   that was used is stored in n_masks_used.
+            convergence_interval: Number of masks that is added between two successive attribution maps when checking
+                                  for convergence.
+            embedding_cache: EmbeddingCache, or path to its database file, to store model predictions in. If the
+                             predictions for an image and a set of masks are in the cache, explain_image_distance
+                             and iter_explain_image_distance restore them instead of running the model. Use a separate
+                             cache for every model and preprocess_function. Cannot be combined with a
+                             convergence_threshold, as a converged explanation does not have the predictions of all
+                             masks.
+            max_batch_bytes: Memory budget for a single batch (masked inputs, preprocessed inputs and predictions)
+                             when batch_size is 'auto'. If scratch_dir is given, also the size of the chunks of masks
+                             and predictions that are read at once to generate masks, calculate distances and
+                             attribution maps, whatever the batch size.
+            prefetch: If True and n_workers is 1, the next batch is masked and preprocessed on a background thread
+                      while the model runs on the current batch.
+            dtype: Floating point type to keep the masks in, for example np.float32 or np.float16. The input data,
+                   masked inputs and attribution maps are then kept in this type as well, or in float32 for float16
+                   masks. If None, the masked inputs have the type of the input data. Rounding the masked inputs
+                   can reorder the distances of nearly equally distant predictions, and so select other masks. Only
+                   when the same masks are selected do the attribution maps agree with those in full precision, to
+                   within 1e-6 for float32 and 1e-3 for float16 masks.
+            distance_metric: Metric to compare predictions with the reference, the name of a metric in
+                             DISTANCE_METRICS ('cosine', 'angular', 'euclidean', 'sqeuclidean' or 'dot') or a
+                             DistanceMetric, like MahalanobisDistance(inverse_covariance). Only the order of the
+                             distances matters for the mask selection, but weighted_selection uses their values.
+            keep_predictions: If False, explain_image_distance and iter_explain_image_distance reduce every batch of
+                              predictions to distances to the reference as it arrives, and only keep the distances
+                              (in distances) instead of all predictions. Saves memory for large embeddings, but
+                              recompute_attribution and save_predictions need the predictions. Cannot be combined
+                              with an embedding cache.
+            scratch_dir: Directory for out-of-core explanations. If given, generated masks and the predictions are
+                         memory-mapped files in this directory, and distances and attribution maps are calculated in
+                         chunks of at most max_batch_bytes (256 MiB by default), so inputs can be explained whose
+                         masks and predictions do not fit in memory. Generating masks out-of-core requires a seed.
+                         The files are removed once the arrays are no longer used.
         """
+        if batch_size != 'auto' and not (isinstance(batch_size, (int, np.integer)) and batch_size > 0):
+            raise ValueError(f"batch_size should be a positive integer or 'auto', not {batch_size!r}.")
+        if not (isinstance(n_workers, (int, np.integer)) and n_workers > 0):
+            raise ValueError(f"n_workers should be a positive integer, not {n_workers!r}.")
+        if backend not in ('thread', 'process'):
+            raise ValueError(f"Unknown backend '{backend}', expected 'thread' or 'process'.")
+        if mask_bank is not None and not isinstance(seed, (int, np.integer)):
+            raise ValueError("A mask bank can only be used with an integer seed.")
+        if mask_cache is not None and not isinstance(seed, (int, np.integer)):
+            raise ValueError("A mask cache can only be used with an integer seed.")
+        if embedding_cache is not None and not keep_predictions:
+            raise ValueError("An embedding cache stores predictions, so it cannot be used with keep_predictions=False.")
+        if embedding_cache is not None and convergence_threshold is not None:
+            raise ValueError("An embedding cache stores the predictions of all masks, so it cannot be used with a "
+                             "convergence_threshold.")
         self.n_masks = n_masks
         self.feature_res = feature_res
         self.p_keep = p_keep
         self.preprocess_function = preprocess_function
         self.masks = None
         self.predictions = None
+        self.distances = None
+        self.keep_predictions = keep_predictions
+        self.scratch_dir = scratch_dir
+        self.input_shape = None
+        self._masks_key = None
         self.axis_labels = axis_labels if axis_labels is not None else []
         self.mask_selection_range_max = mask_selection_range_max
         self.mask_selection_range_min = mask_selection_range_min
         self.mask_selection_negative_range_max = mask_selection_negative_range_max
         self.mask_selection_negative_range_min = mask_selection_negative_range_min
         self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.tuned_batch_size = None
+        self.prefetch = prefetch
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.distance_metric = get_distance_metric(distance_metric)
+        self._tuned_batch_size_input_shape = None
+        self.n_workers = n_workers
+        self.backend = backend
+        self.seed = seed
+        self.mask_bank = MaskBank(mask_bank) if isinstance(mask_bank, (str, os.PathLike)) else mask_bank
+        self.mask_cache = mask_cache
+        self.weighted_selection = weighted_selection
+        self.convergence_threshold = convergence_threshold
+        self.convergence_interval = convergence_interval
+        self.n_masks_used = None
+        self.embedding_cache = (EmbeddingCache(embedding_cache) if isinstance(embedding_cache, (str, os.PathLike))
+                                else embedding_cache)
 
     def explain_image_distance(self, model_or_function, input_data, embedded_reference, masks=None) -> tuple[
         numpy.typing.NDArray, float]:
@@ -58,111 +166,711 @@ class DistanceExplainer:
         Args:
             model_or_function: Model that will encode the input_data into an embedded space
             input_data: Input data to be explained, by exploring what parts make it closer to the reference point.
-            embedded_reference: Reference point in the embedded space
+            embedded_reference: Reference point in the embedded space. A matrix with one reference point per row gives
+                                one attribution map per reference point, from a single run of the model.
             masks: User specified masks, in case no autogenerated masks should be used.
 
         Returns:
             attribution_map map
         """
         full_preprocess_function, input_data = self._prepare_input_data(input_data)
-        runner = dianna.utils.get_function(model_or_function, preprocess_function=full_preprocess_function)
-        active_p_keep = 0.5 if self.p_keep is None else self.p_keep  # Could autotune here (See #319)
-
-        # data shape without batch axis and channel axis
-        img_shape = input_data.shape[1:3]
+        if self.convergence_threshold is not None:
+            return self._explain_until_converged(model_or_function, full_preprocess_function, input_data,
+                                                 self._get_masks(input_data, masks), embedded_reference)
         # Expose masks for to make user inspection possible
-        if masks is None:
-            self.masks = generate_interpolated_float_masks_for_image(img_shape, active_p_keep, self.n_masks,
-                                                                     self.feature_res)
+        self.masks = self._get_masks(input_data, masks)
+        if not self.keep_predictions:
+            # a single attribution map, after the distances of all masks have been calculated batch by batch
+            *_, attribution_map = self._iter_attribution_maps(model_or_function, full_preprocess_function, input_data,
+                                                              self.masks, embedded_reference, len(self.masks))
+            return attribution_map
+        if self.embedding_cache is None:
+            self.predictions = self._predict(model_or_function, full_preprocess_function, input_data, self.masks)
         else:
+            image_hash, masks_id = self._get_embedding_cache_key(input_data)
+            self.predictions = self.embedding_cache.get(image_hash, masks_id, len(self.masks))
+            if self.predictions is None:
+                self.predictions = self._predict(model_or_function, full_preprocess_function, input_data, self.masks)
+                self.embedding_cache.put(image_hash, masks_id, self.predictions)
+        self.n_masks_used = len(self.masks)
+        attribution_map, self.statistics = self._get_attribution(self.masks, self.predictions, embedded_reference)
+        return attribution_map
+
+    def iter_explain_image_distance(self, model_or_function, input_data, embedded_reference, masks=None,
+                                    yield_every=10):
+        """Explain an image with respect to a reference point in an embedded space, yielding intermediate results.
+
+        Yields an attribution map from the masks used so far after every yield_every batches, and a final map that
+        uses all masks and is equal to the result of explain_image_distance. Gives a coarse map quickly, which is
+        refined with every next map. If the predictions are in the embedding cache, only the final map is yielded,
+        and the predictions are added to the cache once all masks have been used.
+
+        Args:
+            model_or_function: Model that will encode the input_data into an embedded space
+            input_data: Input data to be explained, by exploring what parts make it closer to the reference point.
+            embedded_reference: Reference point in the embedded space, or a matrix with one reference point per row
+            masks: User specified masks, in case no autogenerated masks should be used.
+            yield_every: Number of batches to run through the model between two attribution maps
+
+        Yields:
+            attribution_map map, from the first n_masks_used masks
+        """
+        full_preprocess_function, input_data = self._prepare_input_data(input_data)
+        masks = self._get_masks(input_data, masks)
+        if self.embedding_cache is not None:
             self.masks = masks
-            if self.masks.shape[0] != self.n_masks:
-                raise ValueError(f"Configured n_masks ({self.n_masks}) is not equal to the number of masks passed "
-                                 f"({self.masks.shape[0]}).")
+            image_hash, masks_id = self._get_embedding_cache_key(input_data)
+            self.predictions = self.embedding_cache.get(image_hash, masks_id, len(masks))
+            if self.predictions is not None:
+                self.n_masks_used = len(masks)
+                attribution_map, self.statistics = self._get_attribution(masks, self.predictions, embedded_reference)
+                yield attribution_map
+                return
+        self._tune_batch_size(model_or_function, full_preprocess_function, input_data, masks)
+        yield from self._iter_attribution_maps(model_or_function, full_preprocess_function, input_data,
+                                               masks, embedded_reference, yield_every * self._active_batch_size)
+        if self.embedding_cache is not None:
+            self.embedding_cache.put(image_hash, masks_id, self.predictions)
 
-        # Make sure multiplication is being done for correct axes
-        masked = input_data * self.masks
+    def _get_embedding_cache_key(self, input_data):
+        """Identifies the input data and the current masks in the embedding cache."""
+        # the shape and dtype are hashed as well, as inputs of different shapes can have identical bytes
+        image_hash = hashlib.sha256(f'{input_data.shape} {input_data.dtype} '.encode())
+        image_hash.update(np.ascontiguousarray(input_data.values))
+        return image_hash.hexdigest(), self._get_masks_id()
+
+    def _explain_until_converged(self, model_or_function, full_preprocess_function, input_data, masks,
+                                 embedded_reference):
+        """Explains an image using more and more masks, until the attribution map has converged.
+
+        Every convergence_interval masks, the attribution map is calculated from the masks used so far. Once its
+        correlation with the previous map reaches convergence_threshold, the model is not run on the remaining masks.
+
+        Returns:
+            attribution map from the masks used so far
+        """
+        previous_attribution_map = None
+        attribution_maps = self._iter_attribution_maps(model_or_function, full_preprocess_function, input_data, masks,
+                                                       embedded_reference, self.convergence_interval)
+        try:
+            for attribution_map in attribution_maps:
+                if (previous_attribution_map is not None
+                        and _correlation(previous_attribution_map, attribution_map) >= self.convergence_threshold):
+                    break
+                previous_attribution_map = attribution_map
+        finally:
+            attribution_maps.close()
+        return attribution_map
+
+    def _iter_attribution_maps(self, model_or_function, full_preprocess_function, input_data, masks,
+                               embedded_reference, n_masks_per_map):
+        """Runs the model on more and more masks, yielding an attribution map from the masks used so far.
+
+        A map is yielded every n_masks_per_map masks (rounded up to whole batches) and after the last mask. Before a
+        map is yielded, masks, predictions (or distances, if keep_predictions is False), statistics and n_masks_used
+        are updated to the masks used so far. Closing the generator stops the model from running on the remaining
+        masks.
+
+        Yields:
+            attribution map from the masks used so far
+        """
+        self.predictions = self.distances = None
+        next_map = n_masks_per_map
+        batches = self._iter_batch_predictions(model_or_function, full_preprocess_function, input_data, masks)
+        if self.keep_predictions:
+            rows, allocate = batches, self._allocate_predictions
+        else:
+            prepared_reference = self.distance_metric.prepare_reference(embedded_reference)
+            rows = (self.distance_metric.distances(np.asarray(predictions), prepared_reference)
+                    for predictions in batches)
+            allocate = np.empty
+        try:
+            for all_rows, n_masks_used in _write_batches(rows, len(masks), allocate):
+                if n_masks_used < min(next_map, len(masks)):
+                    continue
+                next_map += n_masks_per_map
+
+                self.masks = masks[:n_masks_used]
+                self.n_masks_used = n_masks_used
+                if self.keep_predictions:
+                    self.predictions = all_rows[:n_masks_used]
+                    attribution_map, self.statistics = self._get_attribution(self.masks, self.predictions,
+                                                                             embedded_reference)
+                else:
+                    self.distances = all_rows[:n_masks_used]
+                    attribution_map, self.statistics = self._get_attribution_from_distances(self.masks,
+                                                                                            self.distances)
+                yield attribution_map
+        finally:
+            batches.close()
+
+    def explain_images_distance(self, model_or_function, images, embedded_references, masks=None):
+        """Explain a batch of images, each with respect to its own reference point in an embedded space.
+
+        All images share one set of masks. Masked versions of consecutive images are mixed in the model batches, so
+        every batch is full, and the input data is converted and prepared only once for the whole batch of images.
+
+        Args:
+            model_or_function: Model that will encode the input data into an embedded space
+            images: Batch of input data to be explained. The first axis is the batch axis, the axis_labels of the
+                    explainer describe the axes of a single image.
+            embedded_references: Reference point in the embedded space for every image
+            masks: User specified masks, in case no autogenerated masks should be used.
+
+        Returns:
+            Stacked attribution maps, with the batch axis first
+        """
+        if len(images) != len(embedded_references):
+            raise ValueError(f"Number of images ({len(images)}) is not equal to the number of references "
+                             f"({len(embedded_references)}).")
+        full_preprocess_function, images = self._prepare_input_data(images, batch_axis=True)
+        self.masks = self._get_masks(images, masks)
+        predictions = self._predict(model_or_function, full_preprocess_function, images, self.masks)
+        self.predictions = predictions.reshape(len(images), len(self.masks), *predictions.shape[1:])
+
+        attribution_maps = []
+        statistics = []
+        for i, (image_predictions, embedded_reference) in enumerate(zip(self.predictions, embedded_references)):
+            attribution_map, image_statistics = self._get_attribution(self.masks, image_predictions, embedded_reference)
+            attribution_maps.append(attribution_map)
+            statistics.append(f'Image {i}\n{image_statistics}')
+        self.statistics = '\n'.join(statistics)
+        return np.stack(attribution_maps)
+
+    async def explain_image_distance_async(self, model, input_data, embedded_reference, masks=None, max_in_flight=4):
+        """Explain an image with respect to a reference point in an embedded space, using an asynchronous model.
+
+        Meant for models behind a remote (e.g. HTTP) inference service: up to max_in_flight batch requests are kept
+        waiting on the model at the same time, so the service is not left idle between requests.
+
+        Args:
+            model: Async function that encodes a batch of (preprocessed) input data into an embedded space
+            input_data: Input data to be explained, by exploring what parts make it closer to the reference point.
+            embedded_reference: Reference point in the embedded space
+            masks: User specified masks, in case no autogenerated masks should be used.
+            max_in_flight: Maximum number of batches that are being processed by the model at the same time
+
+        Returns:
+            attribution_map map
+        """
+        if self.batch_size == 'auto':
+            raise ValueError("batch_size='auto' is not supported for asynchronous models.")
+        if not (isinstance(max_in_flight, (int, np.integer)) and max_in_flight > 0):
+            raise ValueError(f"max_in_flight should be a positive integer, not {max_in_flight!r}.")
+        full_preprocess_function, input_data = self._prepare_input_data(input_data)
+        self.masks = self._get_masks(input_data, masks)
+
+        # Every batch in flight needs its own buffer, taking one from the queue also limits the number of batches
+        buffers = asyncio.Queue()
+        for _ in range(max_in_flight):
+            buffers.put_nowait(self._allocate_batch_buffer(input_data, self.masks))
+
+        batch_starts = self._get_batch_starts(input_data, self.masks)
+        self.predictions = None
+        with tqdm(total=len(batch_starts), desc='Explaining') as progress:
+            async def run_batch(start):
+                buffer = await buffers.get()
+                try:
+                    batch = full_preprocess_function(self._mask_batch(input_data, self.masks, start, buffer))
+                    predictions = await model(batch)
+                    # batches finish in any order, each is written to its own slice before its buffer is reused
+                    if self.predictions is None:
+                        self.predictions = self._allocate_predictions((len(self.masks), *predictions.shape[1:]),
+                                                                      predictions.dtype)
+                    self.predictions[start:start + len(predictions)] = predictions
+                finally:
+                    buffers.put_nowait(buffer)
+                progress.update()
+
+            await asyncio.gather(*[run_batch(start) for start in batch_starts])
+
+        attribution_map, self.statistics = self._get_attribution(self.masks, self.predictions, embedded_reference)
+        return attribution_map
+
+    def recompute_attribution(self, embedded_reference, mask_selection_range_min=None, mask_selection_range_max=None,
+                              mask_selection_negative_range_min=None, mask_selection_negative_range_max=None):
+        """Calculates the attribution map again from the stored masks and predictions, without running the model.
+
+        Allows trying other selection ranges or another reference after an explanation, or after load_predictions.
+
+        Args:
+            embedded_reference: Reference point in the embedded space, or a matrix with one reference point per row
+            mask_selection_range_min: Lower end of range of outcomes that will be selected, if not the explainer's.
+            mask_selection_range_max: Top end of range of outcomes that will be selected, if not the explainer's.
+            mask_selection_negative_range_min: Lower end of range of outcomes that will be selected and weighted -1,
+                                               if not the explainer's.
+            mask_selection_negative_range_max: Top end of range of outcomes that will be selected and weighted -1, if
+                                               not the explainer's.
+
+        Returns:
+            attribution_map map
+        """
+        if self.predictions is None:
+            raise ValueError("There are no predictions to recompute the attribution from, explain an image or load "
+                             "predictions first.")
+        self._check_single_image_predictions(self.predictions)
+        selection_ranges = tuple(value if value is not None else default for value, default in zip(
+            (mask_selection_range_min, mask_selection_range_max,
+             mask_selection_negative_range_min, mask_selection_negative_range_max),
+            (self.mask_selection_range_min, self.mask_selection_range_max,
+             self.mask_selection_negative_range_min, self.mask_selection_negative_range_max)))
+        attribution_map, self.statistics = self._get_attribution(self.masks, self.predictions, embedded_reference,
+                                                                 selection_ranges)
+        return attribution_map
+
+    def save_predictions(self, path, include_masks=True):
+        """Saves the predictions of the last explanation, so its attribution can be recomputed later.
+
+        The bundle contains the predictions, the input shape and an identifier of the masks. Masks that were generated
+        with an integer seed can be generated again on loading, so these can be left out with include_masks=False.
+
+        Args:
+            path: Path of the .npz file to save to
+            include_masks: Whether to save the masks as well
+        """
+        if self.predictions is None:
+            raise ValueError("There are no predictions to save, explain an image first.")
+        self._check_single_image_predictions(self.predictions)
+        bundle = {'predictions': self.predictions, 'input_shape': self.input_shape, 'masks_id': self._get_masks_id()}
+        if include_masks:
+            bundle['masks'] = self.masks
+        np.savez(path, **bundle)
+
+    def load_predictions(self, path):
+        """Loads predictions saved by save_predictions, after which recompute_attribution can be used.
+
+        If the masks were not saved, they are generated again, which requires the explainer to be configured with the
+        same n_masks, feature_res, p_keep and seed as the explainer that saved them.
+
+        Args:
+            path: Path of the .npz file to load from
+        """
+        with np.load(path) as bundle:
+            predictions = bundle['predictions']
+            input_shape = tuple(bundle['input_shape'])
+            masks_id = str(bundle['masks_id'])
+            masks = bundle['masks'] if 'masks' in bundle else None
+        self._check_single_image_predictions(predictions)
+        if masks is None:
+            # prepare placeholder input data to find the image shape the masks were generated for
+            masks = self._get_masks(self._prepare_input_data(np.empty(input_shape, dtype=np.uint8))[1], None)
+            if self._masks_key != masks_id:
+                raise ValueError(f"Masks '{masks_id}' of the saved predictions cannot be generated with the settings "
+                                 f"of this explainer ('{self._masks_key}').")
+        if len(predictions) > len(masks):
+            raise ValueError(f"There are more saved predictions ({len(predictions)}) than masks ({len(masks)}).")
+        self._masks_key = masks_id
+        # masks that were not used, because the explanation had converged, have no predictions
+        self.masks = masks[:len(predictions)]
+        self.predictions = predictions
+        self.input_shape = input_shape
+
+    @staticmethod
+    def _check_single_image_predictions(predictions):
+        """Checks that predictions have one row per mask, as for a single image, not a batch of images."""
+        if predictions.ndim != 2:
+            raise ValueError(f"Predictions should have one row per mask, not shape {predictions.shape}. The "
+                             f"predictions of explain_images_distance cannot be saved or recomputed, explain the "
+                             f"image with explain_image_distance instead.")
 
-        batch_predictions = []
+    def _get_masks(self, input_data, masks):
+        """Generates masks for the input data, or checks the user specified masks if there are any."""
+        self._masks_key = None
+        if masks is None:
+            # data shape without batch axis and channel axis
+            img_shape = tuple(input_data.shape[1:3])
+            if isinstance(self.seed, (int, np.integer)):
+                # generated masks can be reproduced from these parameters
+                self._masks_key = (f'{img_shape[0]}x{img_shape[1]}_p{self._active_p_keep}_f{self.feature_res}'
+                                   f'_n{self.n_masks}_s{self.seed}')
+                if self._mask_dtype != np.float32:
+                    self._masks_key += f'_{self._mask_dtype}'
+            if self.mask_cache is not None:
+                key = (img_shape, self._active_p_keep, self.feature_res, self.n_masks, self.seed, self._mask_dtype)
+                return self.mask_cache.get_or_create(key, lambda: self._generate_masks(img_shape))
+            return self._generate_masks(img_shape)
+        if masks.shape[0] != self.n_masks:
+            raise ValueError(f"Configured n_masks ({self.n_masks}) is not equal to the number of masks passed "
+                             f"({masks.shape[0]}).")
+        if self.dtype is not None:
+            masks = masks.astype(self.dtype, copy=False)
+        return masks
+
+    @property
+    def _mask_dtype(self):
+        """Type of generated masks."""
+        return np.dtype(np.float32) if self.dtype is None else self.dtype
+
+    def _get_masks_id(self):
+        """Identifies the current masks, by their generator parameters if they can be reproduced, else by content."""
+        if self._masks_key is not None:
+            return self._masks_key
+        return hashlib.sha256(np.ascontiguousarray(self.masks)).hexdigest()
 
-        for i in tqdm(range(0, self.n_masks, self.batch_size), desc='Explaining'):
-            new_predictions = runner(masked[i:i + self.batch_size])
-            batch_predictions.append(new_predictions)
+    @property
+    def _active_batch_size(self):
+        return self.tuned_batch_size if self.batch_size == 'auto' else self.batch_size
 
-        self.predictions = np.concatenate(batch_predictions)
+    def _tune_batch_size(self, model_or_function, full_preprocess_function, input_data, masks):
+        """Finds the batch size with the highest model throughput within max_batch_bytes, if batch_size is 'auto'.
+
+        The model is run on the first masked inputs with doubling batch sizes, until the throughput has not improved
+        for two sizes in a row or the memory budget is reached. Every size is timed a few times and its fastest run
+        is used, so that timing noise of fast models does not end the search early. The result is stored in
+        tuned_batch_size and reused for input data of the same shape.
+        """
+        if self.batch_size != 'auto' or self._tuned_batch_size_input_shape == input_data.shape[1:]:
+            return
+        runner = dianna.utils.get_function(model_or_function, preprocess_function=full_preprocess_function)
+        n_items = len(input_data) * len(masks)
+        max_batch_size = max(1, min(n_items, self.max_batch_bytes // 2 // _masked_input_nbytes(input_data, masks)))
+        buffer = _allocate_batch_buffer(input_data, masks, max_batch_size)
+
+        # the first run can include one-off costs, like loading the model, so it is not timed
+        predictions = runner(_mask_batch(input_data, masks, 0, 1, buffer))
+        # a batch holds the masked inputs, their preprocessed copy and the predictions
+        item_nbytes = 2 * _masked_input_nbytes(input_data, masks) + np.asarray(predictions).nbytes
+        max_batch_size = max(1, min(max_batch_size, self.max_batch_bytes // item_nbytes))
+
+        n_repeats = 3
+        best_batch_size, best_throughput = 1, 0
+        batch_size = 1
+        n_without_improvement = 0
+        while batch_size <= max_batch_size:
+            duration = np.inf
+            for _ in range(n_repeats):
+                start_time = time.perf_counter()
+                runner(_mask_batch(input_data, masks, 0, batch_size, buffer))
+                duration = min(duration, time.perf_counter() - start_time)
+            throughput = batch_size / max(duration, 1e-9)
+            if throughput > best_throughput:
+                best_batch_size, best_throughput = batch_size, throughput
+                n_without_improvement = 0
+            else:
+                n_without_improvement += 1
+                if n_without_improvement == 2:
+                    break
+            if batch_size == max_batch_size:
+                break
+            batch_size = min(2 * batch_size, max_batch_size)
+        logging.getLogger(__name__).info('Tuned batch size to %d (%.1f masked inputs per second)', best_batch_size,
+                                         best_throughput)
+        self.tuned_batch_size = best_batch_size
+        self._tuned_batch_size_input_shape = input_data.shape[1:]
+
+    @property
+    def _active_p_keep(self):
+        return 0.5 if self.p_keep is None else self.p_keep  # Could autotune here (See #319)
+
+    def _generate_masks(self, img_shape):
+        """Generates masks for an image of img_shape, or loads them from the mask bank."""
+        if self.mask_bank is not None:
+            return self.mask_bank.get(img_shape, self._active_p_keep, self.n_masks, self.feature_res, self.seed,
+                                      dtype=self._mask_dtype)
+        if self.scratch_dir is not None:
+            if self.seed is None:
+                raise ValueError("Masks can only be generated in the scratch directory with a seed.")
+            masks = self._allocate_scratch_array((self.n_masks, *img_shape, 1), self._mask_dtype)
+            return generate_interpolated_float_masks(img_shape, self._active_p_keep, self.n_masks, self.feature_res,
+                                                     rng=np.random.default_rng(self.seed),
+                                                     chunk_size=self._get_chunk_size(masks), out=masks)
+        if self.seed is not None:
+            return generate_interpolated_float_masks(img_shape, self._active_p_keep, self.n_masks, self.feature_res,
+                                                     rng=np.random.default_rng(self.seed), dtype=self._mask_dtype)
+        return generate_interpolated_float_masks_for_image(img_shape, self._active_p_keep, self.n_masks,
+                                                           self.feature_res).astype(self._mask_dtype, copy=False)
+
+    def _get_attribution(self, masks, predictions, embedded_reference, selection_ranges=None):
+        """Calculates the attribution maps from the masks and the predictions for the masked inputs.
+
+        Args:
+            masks: Masks that were applied to the input data
+            predictions: Model predictions for the masked inputs, in mask order
+            embedded_reference: Reference point in the embedded space, or a matrix with one reference point per row
+            selection_ranges: Mask selection ranges (min, max, negative min, negative max) to use instead of the
+                              ranges of the explainer
+
+        Returns:
+            attribution maps (one per reference point), statistics on the selected masks
+        """
+        # Distances to all references at once, shared by the positive and negative mask selection
+        distances = self.calculate_distances(predictions, np.atleast_2d(embedded_reference), self.distance_metric,
+                                             self._get_chunk_size(predictions))
+        return self._get_attribution_from_distances(masks, distances, selection_ranges)
+
+    def _get_attribution_from_distances(self, masks, distances, selection_ranges=None):
+        """Calculates the attribution maps from the masks and the distances of the predictions to the references.
+
+        Args:
+            masks: Masks that were applied to the input data
+            distances: Distances of the predictions for the masked inputs, in mask order, with one column per
+                       reference point
+            selection_ranges: Mask selection ranges (min, max, negative min, negative max) to use instead of the
+                              ranges of the explainer
+
+        Returns:
+            attribution maps (one per reference point), statistics on the selected masks
+        """
 
         def describe(x, name):
             return f'Description of {name}\nmean:{np.mean(x)}\nstd:{np.std(x)}\nmin:{np.min(x)}\nmax:{np.max(x)}'
 
         statistics = []
+        if selection_ranges is None:
+            selection_ranges = (self.mask_selection_range_min, self.mask_selection_range_max,
+                                self.mask_selection_negative_range_min, self.mask_selection_negative_range_max)
+        range_min, range_max, negative_range_min, negative_range_max = selection_ranges
+        n_references = distances.shape[1]
+
+        # One row per reference with the weight of every mask in its attribution map
+        selection = np.zeros((n_references, len(distances)))
+        references = np.arange(n_references)
 
-        highest_distances_masks, highest_mask_weights = self._get_lowest_distance_masks_and_weights(
-            embedded_reference,
-            self.predictions, self.masks,
-            self.mask_selection_negative_range_min,
-            self.mask_selection_negative_range_max)
+        highest_distances_indices, highest_mask_weights = self._get_lowest_distance_indices_and_weights(
+            distances,
+            negative_range_min,
+            negative_range_max)
 
         if len(highest_mask_weights) > 0:
             statistics.append(describe(highest_mask_weights, 'highest_mask_weights'))
-            unnormalized_sal_highest = np.mean(highest_distances_masks, axis=0)
-        else:
-            unnormalized_sal_highest = 0
+            selection[references, highest_distances_indices] -= self._get_selection_weights(
+                np.take_along_axis(distances, highest_distances_indices, axis=0))
 
-        lowest_distances_masks, lowest_mask_weights = self._get_lowest_distance_masks_and_weights(
-            embedded_reference,
-            self.predictions, self.masks,
-            self.mask_selection_range_min,
-            self.mask_selection_range_max)
+        lowest_distances_indices, lowest_mask_weights = self._get_lowest_distance_indices_and_weights(
+            distances,
+            range_min,
+            range_max)
 
         if len(lowest_mask_weights) > 0:
             statistics.append(describe(lowest_mask_weights, 'lowest_mask_weights'))
-            unnormalized_sal_lowest = np.mean(lowest_distances_masks, axis=0)
+            selection[references, lowest_distances_indices] += self._get_selection_weights(
+                np.take_along_axis(distances, lowest_distances_indices, axis=0))
+
+        # (Weighted) mean of the selected masks minus that of the negatively selected masks, for all references in one
+        # product. The selected masks are never gathered into a copy, and float32 masks stay float32, so they are not
+        # copied to match the dtype of the selection either.
+        attribution_maps = _weighted_sum_of_masks(selection, masks, self._get_chunk_size(masks))
+
+        return attribution_maps.reshape(n_references, *masks.shape[1:]), '\n'.join(statistics)
+
+    def _get_selection_weights(self, selected_distances):
+        """Weights of the selected masks in the attribution maps, which sum to 1 for every reference."""
+        if self.weighted_selection:
+            # exp(-distance) relative to the closest selected mask, which is equal after normalization, but cannot
+            # overflow for unbounded metrics like the dot product
+            mask_weights = np.exp(np.fmin.reduce(selected_distances, axis=0, initial=np.inf) - selected_distances)
+            return mask_weights / np.sum(mask_weights, axis=0)
+        return 1 / len(selected_distances)
+
+    def _predict(self, model_or_function, full_preprocess_function, input_data, masks):
+        """Runs the model on all masked versions of the input data, one batch at a time.
+
+        Args:
+            model_or_function: Model that will encode the input_data into an embedded space
+            full_preprocess_function: Function that turns a batch of masked inputs into model input
+            input_data (xarray): Input data with a batch axis and the channels axis last
+            masks: Masks to apply to the input data
+
+        Returns:
+            Model predictions for all masked inputs, in mask order for every image in turn
+        """
+        batches = self._iter_batch_predictions(model_or_function, full_preprocess_function, input_data, masks)
+        for predictions, _ in _write_batches(batches, len(input_data) * len(masks), self._allocate_predictions):
+            pass
+        return predictions
+
+    def _allocate_predictions(self, shape, dtype):
+        """Allocates the array that the predictions for all masked inputs are written into, batch by batch."""
+        if self.scratch_dir is not None:
+            return self._allocate_scratch_array(shape, dtype)
+        return np.empty(shape, dtype=dtype)
+
+    def _allocate_scratch_array(self, shape, dtype):
+        """Creates a memory-mapped .npy file in the scratch directory, which is removed with the array."""
+        os.makedirs(self.scratch_dir, exist_ok=True)
+        file_descriptor, path = tempfile.mkstemp(suffix='.npy', dir=self.scratch_dir)
+        os.close(file_descriptor)
+        array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+        # views of the array keep it alive, so the file is only removed once nothing uses it anymore
+        weakref.finalize(array, os.remove, path)
+        return array
+
+    def _get_chunk_size(self, array):
+        """Number of rows of array to process at once in out-of-core mode, or None to process all rows at once."""
+        if self.scratch_dir is None:
+            return None
+        return max(1, self.max_batch_bytes // max(array.itemsize * int(np.prod(array.shape[1:])), 1))
+
+    def _iter_batch_predictions(self, model_or_function, full_preprocess_function, input_data, masks):
+        """Runs the model on all masked versions of the input data, yielding the predictions one batch at a time.
+
+        Batches are yielded in order, whichever backend runs them. Batches are only run shortly before they are
+        needed, so closing the generator early stops the model from running on the remaining batches.
+
+        Yields:
+            Model predictions for a batch of masked inputs
+        """
+        self._tune_batch_size(model_or_function, full_preprocess_function, input_data, masks)
+        batch_starts = self._get_batch_starts(input_data, masks)
+        if self.n_workers > 1 and self.backend == 'process':
+            batch_predictions = self._iter_batch_predictions_in_processes(model_or_function, full_preprocess_function,
+                                                                          input_data, masks, batch_starts)
         else:
-            unnormalized_sal_lowest = 0
+            batch_predictions = self._iter_batch_predictions_in_threads(model_or_function, full_preprocess_function,
+                                                                        input_data, masks, batch_starts)
+        try:
+            yield from tqdm(batch_predictions, total=len(batch_starts), desc='Explaining')
+        finally:
+            batch_predictions.close()
 
-        self.statistics = '\n'.join(statistics)
-        unnormalized_sal = unnormalized_sal_lowest - unnormalized_sal_highest
+    def _iter_batch_predictions_in_threads(self, model_or_function, full_preprocess_function, input_data, masks,
+                                           batch_starts):
+        """Runs the batches in the current thread, or on a thread pool if n_workers > 1."""
+        if self.n_workers == 1 and self.prefetch:
+            yield from self._iter_batch_predictions_prefetched(model_or_function, full_preprocess_function,
+                                                               input_data, masks, batch_starts)
+            return
 
-        attribution_map = unnormalized_sal
+        runner = dianna.utils.get_function(model_or_function, preprocess_function=full_preprocess_function)
+        if self.n_workers == 1:
+            # every batch is written into the same buffer, so peak memory is bounded by the batch size
+            buffer = self._allocate_batch_buffer(input_data, masks)
+            for start in batch_starts:
+                yield _detach(runner(self._mask_batch(input_data, masks, start, buffer)), buffer)
+            return
 
-        return attribution_map
+        buffers = threading.local()
 
-    @staticmethod
-    def _get_lowest_distance_masks_and_weights(embedded_reference, predictions, masks, mask_selection_range_min,
-                                               mask_selection_range_max):
-        distances = DistanceExplainer.calculate_distances(predictions, embedded_reference[None, ...])
+        def run_batch(start):
+            if not hasattr(buffers, 'buffer'):
+                buffers.buffer = self._allocate_batch_buffer(input_data, masks)
+            return _detach(runner(self._mask_batch(input_data, masks, start, buffers.buffer)), buffers.buffer)
+
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            yield from _ordered_map(executor, run_batch, batch_starts, max_pending=2 * self.n_workers)
+
+    def _iter_batch_predictions_prefetched(self, model_or_function, full_preprocess_function, input_data, masks,
+                                           batch_starts):
+        """Runs the batches in the current thread, while the next batch is prepared on a background thread.
+
+        Masking and preprocessing of the next batch overlap with running the model on the current one. There are two
+        batch buffers, and a buffer is only prepared again after the model is done with the batch that used it.
+        """
+        model = dianna.utils.get_function(model_or_function)
+        buffers = [self._allocate_batch_buffer(input_data, masks) for _ in range(2)]
+
+        def prepare_batch(batch):
+            index, start = batch
+            return full_preprocess_function(self._mask_batch(input_data, masks, start, buffers[index % 2]))
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for index, batch in enumerate(_ordered_map(executor, prepare_batch, enumerate(batch_starts),
+                                                       max_pending=1)):
+                yield _detach(model(batch), buffers[index % 2])
 
-        lowest_distances_indices = np.argsort(distances, axis=0)[
-                                   int(len(predictions) * mask_selection_range_min)
-                                   :int(len(predictions) * mask_selection_range_max)]
-        mask_weights = np.exp(-distances[lowest_distances_indices])
-        lowest_distances_masks = masks[lowest_distances_indices]
-        return lowest_distances_masks, mask_weights
+    def _iter_batch_predictions_in_processes(self, model_or_function, full_preprocess_function, input_data, masks,
+                                             batch_starts):
+        """Runs the batches on a process pool.
+
+        The masks are copied into shared memory once, or memory-mapped by the workers if they come from a file (like
+        a mask bank). Every worker process receives the model and the input data once, when it starts. Workers mask
+        their batches themselves, so only the batch start index and the resulting predictions are pickled per batch.
+        """
+        if isinstance(masks, np.memmap) and isinstance(masks.base, mmap.mmap):
+            masks_memory = None
+            masks_source = ('file', masks.filename, masks.offset)
+        else:
+            masks_memory = shared_memory.SharedMemory(create=True, size=max(masks.nbytes, 1))
+            np.ndarray(masks.shape, dtype=masks.dtype, buffer=masks_memory.buf)[...] = masks
+            masks_source = ('shared_memory', masks_memory.name)
+        try:
+            initargs = (model_or_function, full_preprocess_function, input_data, masks_source, masks.shape,
+                        masks.dtype, self._active_batch_size)
+            with ProcessPoolExecutor(max_workers=self.n_workers, initializer=_init_process_worker,
+                                     initargs=initargs) as executor:
+                yield from _ordered_map(executor, _run_process_worker_batch, batch_starts,
+                                        max_pending=2 * self.n_workers)
+        finally:
+            if masks_memory is not None:
+                masks_memory.close()
+                masks_memory.unlink()
+
+    def _get_batch_starts(self, input_data, masks):
+        """Start positions of the batches in the sequence of all masked inputs, which is ordered by image, then mask."""
+        return range(0, len(input_data) * len(masks), self._active_batch_size)
+
+    def _allocate_batch_buffer(self, input_data, masks):
+        """Allocates a buffer that can hold one batch of masked input data."""
+        return _allocate_batch_buffer(input_data, masks, self._active_batch_size)
+
+    def _mask_batch(self, input_data, masks, start, buffer):
+        """Creates the batch of masked inputs beginning at start, writing the result into buffer.
+
+        Returns:
+            Masked input data with the same axes as input_data, backed by buffer
+        """
+        return _mask_batch(input_data, masks, start, self._active_batch_size, buffer)
 
     @staticmethod
-    def calculate_distances(predictions: np.ndarray, embedded_reference: np.ndarray) -> np.ndarray:
-        """Calculate the distances to the reference point in an embedded space using cosine distance with range [0,1].
+    def _get_lowest_distance_indices_and_weights(distances, mask_selection_range_min, mask_selection_range_max):
+        start = int(len(distances) * mask_selection_range_min)
+        stop = int(len(distances) * mask_selection_range_max)
+        # one column of indices per reference, equal to np.argsort(distances, axis=0, kind='stable')[start:stop]
+        lowest_distances_indices = np.stack([_argsort_window(column, start, stop) for column in distances.T], axis=1)
+        with np.errstate(over='ignore'):  # unbounded metrics, like the dot product, can overflow to inf here
+            mask_weights = np.exp(-np.take_along_axis(distances, lowest_distances_indices, axis=0))
+        return lowest_distances_indices, mask_weights
+
+    @staticmethod
+    def calculate_distances(predictions: np.ndarray, embedded_reference: np.ndarray,
+                            metric='cosine', chunk_size=None) -> np.ndarray:
+        """Calculate the distances to the reference point in an embedded space, by default cosine distance in [0,1].
 
         Args:
             predictions: Batch of points in the embedded space for with distances are calculated
-            embedded_reference: Point to calculate the distance to
+            embedded_reference: Point(s) to calculate the distance to, one per row
+            metric: Name of a metric in DISTANCE_METRICS, or a DistanceMetric
+            chunk_size: If given, distances are calculated for this many predictions at a time, which limits the
+                        size of temporary arrays and reads memory-mapped predictions in pieces.
 
         Returns:
-            Distances from each point to the reference point
+            Distances from each point to each reference point, with one column per reference point
         """
-        distances = pairwise_distances(predictions, embedded_reference,
-                                       metric='cosine') / 2  # divide by 2 to have [0.1] output range
+        metric = get_distance_metric(metric)
+        predictions = np.asarray(predictions)
+        if chunk_size is None:
+            return metric(predictions, embedded_reference)
+        prepared_reference = metric.prepare_reference(embedded_reference)
+        chunks = (metric.distances(predictions[start:start + chunk_size], prepared_reference)
+                  for start in range(0, len(predictions), chunk_size))
+        for distances, _ in _write_batches(chunks, len(predictions), np.empty):
+            pass
         return distances
 
-    def _prepare_input_data(self, input_data):
-        input_data_xarray = dianna.utils.to_xarray(input_data, self.axis_labels, DistanceExplainer.required_labels)
-        input_data_xarray_expanded = input_data_xarray.expand_dims('batch', 0)
+    def _prepare_input_data(self, input_data, batch_axis=False):
+        self.input_shape = np.shape(input_data)
+        if batch_axis:
+            # axis_labels describe a single image, so shift them past the batch axis
+            if isinstance(self.axis_labels, dict):
+                axis_labels = {index + 1 if index >= 0 else index: label for index, label in self.axis_labels.items()}
+                axis_labels[0] = 'batch'
+            else:
+                axis_labels = ['batch'] + list(self.axis_labels)
+            input_data_xarray_expanded = dianna.utils.to_xarray(input_data, axis_labels,
+                                                                DistanceExplainer.required_labels)
+        else:
+            input_data_xarray = dianna.utils.to_xarray(input_data, self.axis_labels,
+                                                       DistanceExplainer.required_labels)
+            input_data_xarray_expanded = input_data_xarray.expand_dims('batch', 0)
         # ensure channels axis is last and keep track of where it was so we can move it back
         channels_axis_index = input_data_xarray_expanded.dims.index('channels')
         prepared_input_data = dianna.utils.move_axis(input_data_xarray_expanded, 'channels', -1)
         # create preprocessing function that puts model input generated by RISE into the right shape and dtype,
         # followed by running the user's preprocessing function
         full_preprocess_function = self._get_full_preprocess_function(channels_axis_index, prepared_input_data.dtype)
+        if self.dtype is not None:
+            # masked inputs take their type from the input data and the masks, so convert the input data only once
+            prepared_input_data = prepared_input_data.astype(np.result_type(self.dtype, np.float32), copy=False)
         return full_preprocess_function, prepared_input_data
 
     def _prepare_image_data(self, input_data):
@@ -196,10 +904,622 @@ class DistanceExplainer:
             Function that first ensures the data has the same shape and type as the input data,
             then runs the users' preprocessing function
         """
+        # a partial of a module level function can be pickled, which the process backend relies on
+        return functools.partial(_full_preprocess, channel_axis_index=channel_axis_index, dtype=dtype,
+                                 preprocess_function=self.preprocess_function)
+
+
+def _full_preprocess(data, channel_axis_index, dtype, preprocess_function):
+    """Moves the channels axis back to where it was in the input data, then runs the user's preprocessing function.
+
+    Works on plain numpy arrays: moving the axis gives a view, and casting only copies if the dtype differs.
+    """
+    data = np.moveaxis(data, -1, channel_axis_index).astype(dtype, copy=False)
+    if preprocess_function is None:
+        return data
+    return preprocess_function(data)
+
+
+def _allocate_batch_buffer(input_data, masks, batch_size):
+    """Allocates a buffer that can hold one batch of masked input data."""
+    dtype = np.result_type(input_data.dtype, masks.dtype)
+    return np.empty((batch_size,) + input_data.shape[1:], dtype=dtype)
+
+
+def _masked_input_nbytes(input_data, masks):
+    """Size in bytes of a single masked input."""
+    return int(np.prod(input_data.shape[1:])) * np.result_type(input_data.dtype, masks.dtype).itemsize
+
+
+def _mask_batch(input_data, masks, start, batch_size, buffer):
+    """Creates a batch of masked inputs, writing the result into buffer.
+
+    The masked inputs of all images form one sequence, ordered by image and then by mask, so a batch can contain
+    masked versions of more than one image.
+
+    Args:
+        input_data (xarray): Input data with a batch axis and the channels axis last
+        masks: Masks to apply to the input data
+        start: Position of the first masked input of the batch in the sequence of all masked inputs
+        batch_size: Maximum number of masked inputs in the batch
+        buffer: Array to write the batch into
+
+    Returns:
+        Masked input data with the same axes as input_data, backed by buffer
+    """
+    stop = min(start + batch_size, len(input_data) * len(masks))
+    batch = buffer[:stop - start]
+    values = input_data.values
+    position = start
+    while position < stop:
+        image_index, mask_index = divmod(position, len(masks))
+        n_masked = min(stop - position, len(masks) - mask_index)
+        # Make sure multiplication is being done for correct axes
+        np.multiply(values[image_index], masks[mask_index:mask_index + n_masked],
+                    out=batch[position - start:position - start + n_masked])
+        position += n_masked
+    return batch
+
+
+def _write_batches(batches, n_rows, allocate):
+    """Writes batches into slices of a single array, instead of concatenating them at the end.
+
+    The array is allocated with allocate(shape, dtype) when the first batch arrives, as its shape and dtype are only
+    known then. There is never a second copy of all rows, and the rows written so far can be used as a view.
+
+    Yields:
+        The array and the number of rows written to it, after every batch
+    """
+    rows = None
+    n_written = 0
+    for batch in batches:
+        if rows is None:
+            rows = allocate((n_rows, *np.shape(batch)[1:]), np.asarray(batch).dtype)
+        rows[n_written:n_written + len(batch)] = batch
+        n_written += len(batch)
+        yield rows, n_written
+
+
+def _detach(predictions, buffer):
+    """Copies predictions that share memory with a batch buffer, which would be overwritten by the next batch.
+
+    Masked inputs are passed to the model without copying when possible, so a model that returns (part of) its input
+    would otherwise return a view on the buffer.
+    """
+    if isinstance(predictions, np.ndarray) and np.may_share_memory(predictions, buffer):
+        return predictions.copy()
+    return predictions
+
+
+def _correlation(a, b):
+    """Pearson correlation between all values of a and b, or NaN if either is constant."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.corrcoef(np.ravel(a), np.ravel(b))[0, 1]
+
+
+def _ordered_map(executor, function, items, max_pending):
+    """Maps function over items on an executor, yielding the results in the order of the items.
+
+    Unlike Executor.map, at most max_pending items are submitted ahead of the results that have been consumed, and
+    items that have not started yet are cancelled when the generator is closed.
+    """
+    items = iter(items)
+    pending = collections.deque(executor.submit(function, item) for item in itertools.islice(items, max_pending))
+    try:
+        while pending:
+            result = pending.popleft().result()
+            # keep the executor busy while the consumer handles the result
+            pending.extend(executor.submit(function, item) for item in itertools.islice(items, 1))
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+# State of a process pool worker, set once by _init_process_worker when the worker starts
+_process_worker_state = {}
+
+
+def _init_process_worker(model_or_function, full_preprocess_function, input_data, masks_source, masks_shape,
+                         masks_dtype, batch_size):
+    """Sets up a process pool worker with the model and a view on the masks in shared memory or in a file."""
+    if masks_source[0] == 'file':
+        _, filename, offset = masks_source
+        masks_memory = None
+        masks = np.memmap(filename, dtype=masks_dtype, mode='r', offset=offset, shape=masks_shape)
+    else:
+        masks_memory = shared_memory.SharedMemory(name=masks_source[1])
+        masks = np.ndarray(masks_shape, dtype=masks_dtype, buffer=masks_memory.buf)
+    _process_worker_state.update(
+        runner=dianna.utils.get_function(model_or_function, preprocess_function=full_preprocess_function),
+        input_data=input_data,
+        masks_memory=masks_memory,  # keep a reference so the shared memory stays attached
+        masks=masks,
+        batch_size=batch_size,
+        buffer=_allocate_batch_buffer(input_data, masks, batch_size))
+
+
+def _run_process_worker_batch(start):
+    """Masks and runs the batch of masks beginning at start in a process pool worker."""
+    state = _process_worker_state
+    return state['runner'](_mask_batch(state['input_data'], state['masks'], start, state['batch_size'],
+                                       state['buffer']))
+
+
+class DistanceMetric:
+    """Distance from points in an embedded space to reference points, where a lower distance means more similar.
+
+    The reference points are prepared once by prepare_reference, e.g. normalized, after which distances can be
+    calculated for any number of (batches of) predictions. Subclasses implement prepare_reference and distances, and
+    can be added to DISTANCE_METRICS to select them by name.
+    """
+
+    def prepare_reference(self, embedded_reference):
+        """Precomputes what is needed from the reference points to calculate distances to them.
+
+        Args:
+            embedded_reference: Reference points, one per row
+
+        Returns:
+            Prepared reference points, to pass to distances
+        """
+        return np.atleast_2d(embedded_reference)
+
+    def distances(self, predictions, prepared_reference):
+        """Calculates the distances from each prediction to each prepared reference point.
+
+        Args:
+            predictions: Points in the embedded space, one per row
+            prepared_reference: Reference points, as returned by prepare_reference
+
+        Returns:
+            Distances with one row per prediction and one column per reference point
+        """
+        raise NotImplementedError
+
+    def __call__(self, predictions, embedded_reference):
+        """Calculates the distances from each prediction to each reference point."""
+        return self.distances(np.asarray(predictions), self.prepare_reference(embedded_reference))
+
+
+class CosineDistance(DistanceMetric):
+    """Cosine distance divided by 2, so that it is in the range [0, 1]."""
+
+    def __init__(self, chunk_bytes=2 ** 18):
+        """Creates a cosine distance metric.
+
+        Args:
+            chunk_bytes: Size of the chunks of predictions whose norms and dot products are calculated together. Small
+                         enough chunks stay in the CPU cache between the two.
+        """
+        self.chunk_bytes = chunk_bytes
+
+    def prepare_reference(self, embedded_reference):
+        """Normalizes the reference points to unit length."""
+        return _normalize_rows(np.atleast_2d(embedded_reference))
+
+    def distances(self, predictions, prepared_reference):
+        """Calculates the cosine distances to the normalized reference points."""
+        distances = self._similarities(predictions, prepared_reference)
+        np.subtract(1, distances, out=distances)
+        np.clip(distances, 0, 2, out=distances)
+        return np.divide(distances, 2, out=distances)
+
+    def _similarities(self, predictions, prepared_reference):
+        """Calculates the cosine similarities to the normalized reference points.
+
+        The predictions are not normalized into a copy. Instead, their norms and their dot products with the
+        references are calculated chunk by chunk, while the chunk is in cache, and divided into a single output array.
+        """
+        similarities = np.empty((len(predictions), len(prepared_reference)),
+                                dtype=np.result_type(predictions.dtype, prepared_reference.dtype))
+        chunk_size = max(1, self.chunk_bytes // max(predictions[:1].nbytes, 1))
+        for start in range(0, len(predictions), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            norms = np.sqrt(np.einsum('ij,ij->i', predictions[chunk], predictions[chunk]))
+            norms[norms == 0] = 1
+            np.matmul(predictions[chunk], prepared_reference.T, out=similarities[chunk])
+            similarities[chunk] /= norms[:, None]
+        return similarities
+
+
+class AngularDistance(CosineDistance):
+    """Angle between the points divided by pi, so that it is in the range [0, 1]."""
+
+    def distances(self, predictions, prepared_reference):
+        """Calculates the angular distances to the normalized reference points."""
+        distances = self._similarities(predictions, prepared_reference)
+        np.clip(distances, -1, 1, out=distances)
+        np.arccos(distances, out=distances)
+        return np.divide(distances, np.pi, out=distances)
+
+
+class EuclideanDistance(DistanceMetric):
+    """Euclidean distance."""
+
+    def prepare_reference(self, embedded_reference):
+        """Precomputes the squared norms of the reference points."""
+        embedded_reference = np.atleast_2d(embedded_reference)
+        return embedded_reference, np.einsum('ij,ij->i', embedded_reference, embedded_reference)
+
+    def distances(self, predictions, prepared_reference):
+        """Calculates the euclidean distances to the reference points."""
+        return np.sqrt(self._squared_distances(predictions, prepared_reference))
+
+    @staticmethod
+    def _squared_distances(predictions, prepared_reference):
+        embedded_reference, squared_reference_norms = prepared_reference
+        squared_distances = (np.einsum('ij,ij->i', predictions, predictions)[:, None]
+                             - 2 * predictions @ embedded_reference.T)
+        squared_distances += squared_reference_norms
+        # rounding errors can make the distance of (nearly) equal points slightly negative
+        return np.maximum(squared_distances, 0, out=squared_distances)
+
+
+class SquaredEuclideanDistance(EuclideanDistance):
+    """Squared euclidean distance."""
+
+    def distances(self, predictions, prepared_reference):
+        """Calculates the squared euclidean distances to the reference points."""
+        return self._squared_distances(predictions, prepared_reference)
+
+
+class DotProductDistance(DistanceMetric):
+    """Negative dot product, for embeddings that are compared by dot product similarity."""
+
+    def distances(self, predictions, prepared_reference):
+        """Calculates the negative dot products with the reference points."""
+        return -(predictions @ prepared_reference.T)
+
+
+class MahalanobisDistance(DistanceMetric):
+    """Mahalanobis distance, given the inverse of the covariance matrix of the embedded space."""
+
+    def __init__(self, inverse_covariance):
+        """Creates a Mahalanobis distance metric.
+
+        Args:
+            inverse_covariance: Symmetric inverse covariance matrix, with the size of the embedded space on both axes
+        """
+        self.inverse_covariance = np.asarray(inverse_covariance)
+
+    def prepare_reference(self, embedded_reference):
+        """Precomputes the reference points multiplied by the inverse covariance, and their squared norms."""
+        embedded_reference = np.atleast_2d(embedded_reference)
+        transformed_reference = self.inverse_covariance @ embedded_reference.T
+        return transformed_reference, np.einsum('ji,ij->i', transformed_reference, embedded_reference)
+
+    def distances(self, predictions, prepared_reference):
+        """Calculates the Mahalanobis distances to the reference points."""
+        transformed_reference, squared_reference_norms = prepared_reference
+        squared_distances = (np.einsum('ij,ij->i', predictions @ self.inverse_covariance, predictions)[:, None]
+                             - 2 * predictions @ transformed_reference)
+        squared_distances += squared_reference_norms
+        return np.sqrt(np.maximum(squared_distances, 0, out=squared_distances))
+
+
+# distance metrics that can be selected by name, see get_distance_metric
+DISTANCE_METRICS = {
+    'cosine': CosineDistance,
+    'angular': AngularDistance,
+    'euclidean': EuclideanDistance,
+    'sqeuclidean': SquaredEuclideanDistance,
+    'dot': DotProductDistance,
+    'mahalanobis': MahalanobisDistance,
+}
+
+
+def get_distance_metric(metric, **kwargs):
+    """Gets a distance metric by name, or returns metric itself if it is a DistanceMetric.
+
+    Args:
+        metric: Name of a metric in DISTANCE_METRICS, or a DistanceMetric
+        kwargs: Arguments for the metric, like inverse_covariance for 'mahalanobis'
+
+    Returns:
+        DistanceMetric
+    """
+    if isinstance(metric, DistanceMetric):
+        return metric
+    if metric not in DISTANCE_METRICS:
+        raise ValueError(f"Unknown distance metric {metric!r}, expected one of {', '.join(DISTANCE_METRICS)}.")
+    if metric == 'mahalanobis' and 'inverse_covariance' not in kwargs:
+        raise ValueError("The 'mahalanobis' metric needs the inverse covariance of the embedded space, pass "
+                         "MahalanobisDistance(inverse_covariance) instead of its name.")
+    return DISTANCE_METRICS[metric](**kwargs)
+
+
+def _normalize_rows(x):
+    """Divides every row by its euclidean norm, leaving rows of zeros as they are."""
+    norms = np.sqrt(np.einsum('ij,ij->i', x, x))
+    norms[norms == 0] = 1
+    return x / norms[:, None]
+
+
+class MaskCache:
+    """In-memory cache of generated masks with a maximum size in bytes, evicting the least recently used masks.
+
+    Can be shared between explainers and threads. Cached masks are made read only, so that one user cannot change the
+    masks of another.
+    """
+
+    def __init__(self, max_bytes):
+        """Creates an empty mask cache.
+
+        Args:
+            max_bytes: Maximum total size of the cached masks. Masks larger than this are never cached.
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._masks = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        """Total size of the cached masks in bytes."""
+        return sum(masks.nbytes for masks in self._masks.values())
+
+    def get_or_create(self, key, create):
+        """Gets the masks for key from the cache, or creates them with create() and caches them.
+
+        Args:
+            key: Hashable key identifying the masks, e.g. (image shape, p_keep, feature_res, n_masks, seed)
+            create: Function without arguments that creates the masks
+
+        Returns:
+            Read only masks
+        """
+        with self._lock:
+            if key in self._masks:
+                self.hits += 1
+                self._masks.move_to_end(key)
+                return self._masks[key]
+            self.misses += 1
+        masks = create()
+        masks.flags.writeable = False
+        with self._lock:
+            if masks.nbytes <= self.max_bytes:
+                self._masks[key] = masks
+                self._masks.move_to_end(key)
+                while self.nbytes > self.max_bytes:
+                    self._masks.popitem(last=False)
+        return masks
+
+    def clear(self):
+        """Removes all masks from the cache and resets the hit and miss counters."""
+        with self._lock:
+            self._masks.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class EmbeddingCache:
+    """SQLite database of model predictions for masked inputs, to explain an image again without running the model.
+
+    Predictions are stored per mask, keyed by a hash of the input image, an identifier of the set of masks and the
+    index of the mask. The cache does not know which model made the predictions, so use a separate cache (database
+    file) for every model and preprocessing function.
+    """
+
+    def __init__(self, path):
+        """Opens the cache in the database file at path, which is created if it does not exist yet.
+
+        Args:
+            path: Path to the SQLite database file
+        """
+        self.path = path
+        with contextlib.closing(sqlite3.connect(self.path)) as connection, connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS embeddings (image_hash TEXT, masks_id TEXT, '
+                               'mask_index INTEGER, dtype TEXT, shape TEXT, embedding BLOB, '
+                               'PRIMARY KEY (image_hash, masks_id, mask_index))')
+
+    def get(self, image_hash, masks_id, n_masks):
+        """Gets the predictions for all masks of a set of masks applied to an image.
+
+        Args:
+            image_hash: Hash of the input image
+            masks_id: Identifier of the set of masks
+            n_masks: Number of masks in the set
+
+        Returns:
+            Predictions in mask order, or None if the predictions for one or more masks are not in the cache
+        """
+        with contextlib.closing(sqlite3.connect(self.path)) as connection:
+            rows = connection.execute('SELECT dtype, shape, embedding FROM embeddings '
+                                      'WHERE image_hash = ? AND masks_id = ? AND mask_index < ? ORDER BY mask_index',
+                                      (image_hash, masks_id, n_masks)).fetchall()
+        if len(rows) < n_masks:
+            return None
+        return np.stack([np.frombuffer(embedding, dtype=dtype).reshape(json.loads(shape))
+                         for dtype, shape, embedding in rows])
+
+    def put(self, image_hash, masks_id, predictions):
+        """Stores the predictions for all masks of a set of masks applied to an image.
+
+        Args:
+            image_hash: Hash of the input image
+            masks_id: Identifier of the set of masks
+            predictions: Predictions in mask order
+        """
+        rows = [(image_hash, masks_id, mask_index, str(prediction.dtype), json.dumps(prediction.shape),
+                 np.ascontiguousarray(prediction).tobytes())
+                for mask_index, prediction in enumerate(np.asarray(predictions))]
+        with contextlib.closing(sqlite3.connect(self.path)) as connection, connection:
+            connection.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+
+class MaskBank:
+    """Directory of generated masks that are stored once and memory-mapped on every later use.
+
+    Masks are stored per combination of image shape, p_keep, feature_res, n_masks and seed, as .npy files. Because
+    the files are memory-mapped read only, all processes that use the same mask bank share one physical copy of the
+    masks through the page cache.
+    """
+
+    def __init__(self, directory):
+        """Creates a mask bank in directory, which is created if it does not exist yet.
+
+        Args:
+            directory: Directory to store the masks in
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, image_shape, p_keep, n_masks, feature_res, seed, dtype=np.float32):
+        """Path of the file with the masks for the given parameters."""
+        height, width = image_shape[:2]
+        dtype_suffix = '' if np.dtype(dtype) == np.float32 else f'_{np.dtype(dtype)}'
+        return os.path.join(self.directory,
+                            f'masks_{height}x{width}_p{p_keep}_f{feature_res}_n{n_masks}_s{seed}{dtype_suffix}.npy')
+
+    def get(self, image_shape, p_keep, n_masks, feature_res, seed, dtype=np.float32):
+        """Gets the masks for the given parameters, generating and storing them first if they are not in the bank.
+
+        Args:
+            image_shape: Shape of the image, only the first two (spatial) dimensions are used
+            p_keep: Probability of keeping a cell of the grid unmasked
+            n_masks: Number of masks
+            feature_res: Number of features (or blobs) in both dimensions
+            seed: Integer seed to generate the masks with
+            dtype: Floating point type of the masks
+
+        Returns:
+            Read only memory-mapped masks, as generated by generate_interpolated_float_masks
+        """
+        path = self.path(image_shape, p_keep, n_masks, feature_res, seed, dtype)
+        if not os.path.exists(path):
+            masks = generate_interpolated_float_masks(image_shape, p_keep, n_masks, feature_res,
+                                                      rng=np.random.default_rng(seed), dtype=dtype)
+            # write to a temporary file first, so concurrent users never see a partially written file
+            file_descriptor, temporary_path = tempfile.mkstemp(suffix='.npy', dir=self.directory)
+            try:
+                with os.fdopen(file_descriptor, 'wb') as file:
+                    np.save(file, masks)
+                os.replace(temporary_path, path)
+            except BaseException:
+                os.remove(temporary_path)
+                raise
+        return np.load(path, mmap_mode='r')
+
+
+def generate_interpolated_float_masks(image_shape, p_keep, n_masks, feature_res, rng=None, chunk_size=1000,
+                                      dtype=np.float32, out=None):
+    """Generates random masks of float values to mask image data, using batched numpy operations.
+
+    Produces masks that are statistically equivalent to dianna's generate_interpolated_float_masks_for_image: a
+    random grid of feature_res x feature_res cells is linearly upsampled to slightly more than the image size and
+    cropped at a random offset. The upsampling of all grids is done as matrix products with precomputed
+    interpolation weights instead of a resize per mask.
+
+    Args:
+        image_shape: Shape of the image, only the first two (spatial) dimensions are used
+        p_keep: Probability of keeping a cell of the grid unmasked
+        n_masks: Number of masks
+        feature_res: Number of features (or blobs) in both dimensions
+        rng: numpy.random.Generator to draw from. A new unseeded generator is used if None.
+        chunk_size: Number of masks to upsample at once, limits the size of temporary arrays
+        dtype: Floating point type of the masks. Upsampling is done in float32 and rounded to dtype per chunk.
+        out: Array of shape (n_masks, height, width, 1) to write the masks into, chunk by chunk, for example a
+             memory-mapped file. Its dtype is used instead of dtype.
+
+    Returns:
+        Masks with shape (n_masks, height, width, 1) and the given dtype, or out
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    mask_shape = tuple(image_shape[:2])
+    cell_size = np.ceil(np.array(mask_shape) / feature_res).astype(int)
+    up_size = (feature_res + 1) * cell_size
+
+    grid = (rng.random((n_masks, feature_res, feature_res)) < p_keep).astype(np.float32)
+    y_offsets = rng.integers(0, cell_size[0], n_masks)
+    x_offsets = rng.integers(0, cell_size[1], n_masks)
+
+    y_weights = _linear_interpolation_weights(feature_res, up_size[0])
+    x_weights = _linear_interpolation_weights(feature_res, up_size[1])
+
+    if out is None:
+        out = np.empty((n_masks, *mask_shape, 1), dtype=dtype)
+    masks = out.reshape(n_masks, *mask_shape)
+    for start in range(0, n_masks, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        # rows of the upsampled grid that end up in each cropped mask of the chunk
+        y_rows = y_offsets[chunk, None] + np.arange(mask_shape[0])
+        x_rows = x_offsets[chunk, None] + np.arange(mask_shape[1])
+        # (H, f) @ (f, f) @ (f, W) for every mask in the chunk
+        np.matmul(y_weights[y_rows], grid[chunk] @ x_weights[x_rows].transpose(0, 2, 1), out=masks[chunk])
+    return out
+
+
+def _weighted_sum_of_masks(weights, masks, chunk_size=None):
+    """Sums the masks weighted by every row of weights, in float32 or the dtype of the masks if that is wider.
+
+    Masks of a narrower type, like float16, are converted chunk_size (by default 1000) masks at a time, so there is
+    never a converted copy of all masks. If chunk_size is given, masks are always summed in chunks, e.g. to read
+    memory-mapped masks in pieces.
+
+    Returns:
+        Array with one flattened weighted sum of the masks per row of weights
+    """
+    dtype = np.result_type(masks.dtype, np.float32)
+    flat_masks = masks.reshape(len(masks), -1)
+    weights = weights.astype(dtype)
+    if chunk_size is None:
+        if flat_masks.dtype == dtype:
+            return weights @ flat_masks
+        chunk_size = 1000
+    weighted_sum = np.zeros((len(weights), flat_masks.shape[1]), dtype=dtype)
+    for start in range(0, len(masks), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        weighted_sum += weights[:, chunk] @ flat_masks[chunk].astype(dtype)
+    return weighted_sum
+
+
+def _linear_interpolation_weights(in_size, out_size):
+    """Creates the matrix that linearly upsamples an axis from in_size to out_size.
+
+    Matches skimage.transform.resize with order=1, mode='reflect' and anti_aliasing=False, as used by dianna.
+
+    Returns:
+        Weights with shape (out_size, in_size) and dtype float32
+    """
+    positions = (np.arange(out_size) + 0.5) * (in_size / out_size) - 0.5
+    # reflect positions outside the grid around the outermost cell centers
+    positions = np.abs(positions)
+    positions = np.where(positions > in_size - 1, 2 * (in_size - 1) - positions, positions).clip(0, in_size - 1)
+    lower = np.floor(positions).astype(int)
+    upper = np.minimum(lower + 1, in_size - 1)
+    fraction = positions - lower
+    weights = np.zeros((out_size, in_size))
+    np.add.at(weights, (np.arange(out_size), lower), 1 - fraction)
+    np.add.at(weights, (np.arange(out_size), upper), fraction)
+    return weights.astype(np.float32)
+
+
+def _argsort_window(values, start, stop):
+    """Finds the indices of the values that rank from start to stop, using partial selection instead of a full sort.
+
+    The result, including its order and the handling of ties, is identical to
+    ``np.argsort(values, kind='stable')[start:stop]``.
 
-        def moveaxis_function(data):
-            return dianna.utils.move_axis(data, 'channels', channel_axis_index).astype(dtype).values
+    Args:
+        values: 1D array of values to rank
+        start: First rank to select
+        stop: Rank up to which (exclusive) to select
 
-        if self.preprocess_function is None:
-            return moveaxis_function
-        return lambda data: self.preprocess_function(moveaxis_function(data))
+    Returns:
+        Indices of the selected values, sorted by value and then by index
+    """
+    start, stop, _ = slice(start, stop).indices(len(values))
+    if stop <= start:
+        return np.empty(0, dtype=np.intp)
+    lowest, highest = np.partition(values, (start, stop - 1))[[start, stop - 1]]
+    if np.isnan(highest):
+        # NaN sorts last but does not compare, so let a full sort deal with it
+        return np.argsort(values, kind='stable')[start:stop]
+    # Only values in [lowest, highest] can end up in the window. Any tied values at the boundaries are among these
+    # candidates, which are in index order, so a stable sort of the candidates breaks ties exactly like a full sort.
+    candidates = np.flatnonzero((values >= lowest) & (values <= highest))
+    candidates = candidates[np.argsort(values[candidates], kind='stable')]
+    n_lower = np.count_nonzero(values < lowest)
+    return candidates[start - n_lower:stop - n_lower]
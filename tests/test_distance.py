@@ -1,11 +1,25 @@
 """Tests for the distance_explainer."""
+import asyncio
 import dataclasses
 import os
+import threading
+import time
 from typing import Callable
 import numpy as np
 import pytest
+from dianna.utils.maskers import _upscale
+from dianna.utils.maskers import generate_interpolated_float_masks_for_image
 from numpy.typing import ArrayLike
+from distance_explainer import CosineDistance
 from distance_explainer import DistanceExplainer
+from distance_explainer import DotProductDistance
+from distance_explainer import EmbeddingCache
+from distance_explainer import MahalanobisDistance
+from distance_explainer import MaskBank
+from distance_explainer import MaskCache
+from distance_explainer import _argsort_window
+from distance_explainer import _linear_interpolation_weights
+from distance_explainer import generate_interpolated_float_masks
 from tests.config import Config
 from tests.config import get_default_config
 
@@ -33,6 +47,11 @@ def dummy_data() -> tuple[ArrayLike, ArrayLike]:
     return embedded_reference, input_arr
 
 
+def deterministic_model(x):
+    """Get an embedding that only depends on the input."""
+    return x.reshape(x.shape[0], -1)[:, :DUMMY_EMBEDDING_DIMENSIONALITY]
+
+
 def get_explainer(config: Config, axis_labels={2: 'channels'}, preprocess_function=None) -> DistanceExplainer:
     """Get explainer object."""
     explainer = DistanceExplainer(mask_selection_range_max=config.mask_selection_range_max,
@@ -57,7 +76,7 @@ def test_distance_explainer_saliency(dummy_data: tuple[ArrayLike, ArrayLike],
     saliency = explainer.explain_image_distance(dummy_model, input_arr, embedded_reference)
 
     assert saliency.shape == (1,) + input_arr.shape[:2] + (1,)  # Has correct shape
-    assert np.allclose(expected_saliency, saliency)  # Has correct saliency
+    assert np.allclose(expected_saliency, saliency, atol=1e-6)  # Has correct saliency, up to float32 precision
 
 
 @pytest.mark.parametrize("empty_side,expected_tag",
@@ -76,4 +95,710 @@ def test_distance_explainer_one_sided_saliency(dummy_data: tuple[ArrayLike, Arra
 
     saliency = explainer.explain_image_distance(dummy_model, input_arr, embedded_reference)
     assert saliency.shape == (1,) + input_arr.shape[:2] + (1,)  # Has correct shape
-    assert np.allclose(expected_saliency, saliency)  # Has correct saliency
+    assert np.allclose(expected_saliency, saliency, atol=1e-6)  # Has correct saliency, up to float32 precision
+
+
+def test_distance_explainer_predictions_match_unbatched_masking(dummy_data: tuple[ArrayLike, ArrayLike]):
+    """Streaming the masked inputs in batches should give the same predictions as masking all inputs at once."""
+    embedded_reference, input_arr = dummy_data
+    explainer = get_explainer(dataclasses.replace(get_default_config(), number_of_masks=25))
+
+    explainer.explain_image_distance(deterministic_model, input_arr, embedded_reference)
+
+    expected_predictions = deterministic_model(input_arr[None, ...] * explainer.masks)
+    assert np.array_equal(expected_predictions, explainer.predictions)
+
+
+def test_distance_explainer_calculates_distances_once(dummy_data: tuple[ArrayLike, ArrayLike],
+                                                      dummy_model: Callable,
+                                                      monkeypatch: pytest.MonkeyPatch):
+    """Positive and negative mask selection should share a single distance calculation."""
+    embedded_reference, input_arr = dummy_data
+    explainer = get_explainer(dataclasses.replace(get_default_config(), number_of_masks=20))
+    calls = []
+    calculate_distances = DistanceExplainer.calculate_distances
+
+    def counting_calculate_distances(*args):
+        calls.append(args)
+        return calculate_distances(*args)
+
+    monkeypatch.setattr(DistanceExplainer, 'calculate_distances', staticmethod(counting_calculate_distances))
+
+    explainer.explain_image_distance(dummy_model, input_arr, embedded_reference)
+
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize("start,stop", [(0, 20), (0, 0), (80, 100), (13, 57), (0, 100), (99, 100), (40, 41)])
+def test_argsort_window_matches_full_sort(start: int, stop: int):
+    """Partial selection should select the same indices, in the same order, as slicing a stable full sort."""
+    values = np.random.randint(0, 10, size=100).astype(float)  # many ties
+    values[[3, 60]] = np.nan
+
+    selected = _argsort_window(values, start, stop)
+
+    assert np.array_equal(np.argsort(values, kind='stable')[start:stop], selected)
+
+
+def test_distance_explainer_threaded_saliency_identical(dummy_data: tuple[ArrayLike, ArrayLike]):
+    """Running batches on a thread pool should give exactly the same results as running them one after another."""
+    embedded_reference, input_arr = dummy_data
+    config = dataclasses.replace(get_default_config(), number_of_masks=95)
+    sequential_explainer = get_explainer(config)
+    threaded_explainer = get_explainer(config)
+    threaded_explainer.n_workers = 4
+
+    expected_saliency = sequential_explainer.explain_image_distance(deterministic_model, input_arr, embedded_reference)
+    saliency = threaded_explainer.explain_image_distance(deterministic_model, input_arr, embedded_reference,
+                                                         masks=sequential_explainer.masks)
+
+    assert np.array_equal(sequential_explainer.predictions, threaded_explainer.predictions)
+    assert np.array_equal(expected_saliency, saliency)
+
+
+def test_distance_explainer_process_backend_identical(dummy_data: tuple[ArrayLike, ArrayLike]):
+    """Running batches on a process pool should give exactly the same predictions as running them one after another."""
+    embedded_reference, input_arr = dummy_data
+    config = dataclasses.replace(get_default_config(), number_of_masks=45)
+    sequential_explainer = get_explainer(config)
+    process_explainer = get_explainer(config)
+    process_explainer.n_workers = 2
+    process_explainer.backend = 'process'
+
+    sequential_explainer.explain_image_distance(deterministic_model, input_arr, embedded_reference)
+    process_explainer.explain_image_distance(deterministic_model, input_arr, embedded_reference,
+                                             masks=sequential_explainer.masks)
+
+    assert np.array_equal(sequential_explainer.predictions, process_explainer.predictions)
+
+
+def test_distance_explainer_async_identical(dummy_data: tuple[ArrayLike, ArrayLike]):
+    """The async explainer should keep several batches in flight and give the same results as the sync explainer."""
+    embedded_reference, input_arr = dummy_data
+    config = dataclasses.replace(get_default_config(), number_of_masks=95)
+    sync_explainer = get_explainer(config)
+    async_explainer = get_explainer(config)
+    in_flight = 0
+    max_in_flight = 0
+
+    async def stub_embedding_service(x):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return deterministic_model(x)
+
+    expected_saliency = sync_explainer.explain_image_distance(deterministic_model, input_arr, embedded_reference)
+    saliency = asyncio.run(async_explainer.explain_image_distance_async(stub_embedding_service, input_arr,
+                                                                        embedded_reference,
+                                                                        masks=sync_explainer.masks, max_in_flight=3))
+
+    assert max_in_flight == 3
+    assert np.array_equal(sync_explainer.predictions, async_explainer.predictions)
+    assert np.array_equal(expected_saliency, saliency)
+    with pytest.raises(ValueError, match="max_in_flight"):
+        asyncio.run(async_explainer.explain_image_distance_async(stub_embedding_service, input_arr, embedded_reference,
+                                                                 max_in_flight=0))
+
+
+def test_generate_interpolated_float_masks_seeded():
+    """Masks generated with equally seeded generators should be identical and have the expected shape and type."""
+    masks = generate_interpolated_float_masks((32, 20), 0.5, 50, 8, rng=np.random.default_rng(0))
+    same_masks = generate_interpolated_float_masks((32, 20), 0.5, 50, 8, rng=np.random.default_rng(0), chunk_size=7)
+
+    assert masks.shape == (50, 32, 20, 1)
+    assert masks.dtype == np.float32
+    assert np.array_equal(masks, same_masks)
+
+
+@pytest.mark.parametrize("p_keep", [0.2, 0.5, 0.9])
+def test_generate_interpolated_float_masks_equivalent_to_dianna(p_keep: float):
+    """Vectorized masks should be statistically equivalent to the masks of dianna's generator."""
+    n_masks = 2000
+    masks = generate_interpolated_float_masks((32, 32), p_keep, n_masks, 8, rng=np.random.default_rng(0))
+    dianna_masks = generate_interpolated_float_masks_for_image((32, 32), p_keep, n_masks, 8)
+
+    assert masks.shape == dianna_masks.shape
+    assert np.isclose(np.mean(masks), np.mean(dianna_masks), atol=0.01)
+    assert np.isclose(np.std(masks), np.std(dianna_masks), atol=0.01)
+    assert np.allclose(np.mean(masks, axis=0), np.mean(dianna_masks, axis=0), atol=0.05)
+
+
+def test_linear_interpolation_weights_match_dianna_upscale():
+    """Upsampling a grid with the interpolation weights should match dianna's per-mask resize."""
+    grid = np.random.random((8, 8)).astype(np.float32)
+
+    upscaled = _linear_interpolation_weights(8, 45) @ grid @ _linear_interpolation_weights(8, 36).T
+
+    assert np.allclose(_upscale(grid, (45, 36)), upscaled, atol=1e-6)
+
+
+def test_distance_explainer_seeded_masks(dummy_data: tuple[ArrayLike, ArrayLike], dummy_model: Callable):
+    """An explainer with a seed should generate the same masks on every call."""
+    embedded_reference, input_arr = dummy_data
+    explainer = get_explainer(dataclasses.replace(get_default_config(), number_of_masks=20))
+    explainer.seed = 0
+
+    explainer.explain_image_distance(dummy_model, input_arr, embedded_reference)
+    first_masks = explainer.masks
+    explainer.explain_image_distance(dummy_model, input_arr, embedded_reference)
+
+    assert np.array_equal(first_masks, explainer.masks)
+
+
+def test_mask_bank_stores_and_memory_maps_masks(tmp_path):
+    """Masks from the mask bank should be generated once and then memory-mapped from disk."""
+    mask_bank = MaskBank(tmp_path)
+
+    masks = mask_bank.get((32, 20), 0.5, 30, 8, seed=1)
+    modification_time = os.path.getmtime(mask_bank.path((32, 20), 0.5, 30, 8, seed=1))
+    same_masks = mask_bank.get((32, 20), 0.5, 30, 8, seed=1)
+
+    assert isinstance(same_masks, np.memmap)
+    assert modification_time == os.path.getmtime(mask_bank.path((32, 20), 0.5, 30, 8, seed=1))
+    assert np.array_equal(generate_interpolated_float_masks((32, 20), 0.5, 30, 8, rng=np.random.default_rng(1)),
+                          masks)
+    assert np.array_equal(masks, same_masks)
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_distance_explainer_mask_bank_process_backend(dummy_data: tuple[ArrayLike, ArrayLike], tmp_path):
+    """Process pool workers should memory-map masks from the mask bank and give the same predictions."""
+    embedded_reference, input_arr = dummy_data
+    explainer = DistanceExplainer(n_masks=45, axis_labels={2: 'channels'}, seed=0, mask_bank=tmp_path, n_workers=2,
+                                  backend='process')
+    sequential_explainer = DistanceExplainer(n_masks=45, axis_labels={2: 'channels'}, seed=0)
+
+    explainer.explain_image_distance(deterministic_model, input_arr, embedded_reference)
+    sequential_explainer.explain_image_distance(deterministic_model, input_arr, embedded_reference)
+
+    assert isinstance(explainer.masks, np.memmap)
+    assert np.array_equal(sequential_explainer.predictions, explainer.predictions)
+
+
+def test_distance_explainer_mask_bank_requires_seed(tmp_path):
+    """Masks in a mask bank can only be reproduced with an integer seed."""
+    with pytest.raises(ValueError):
+        DistanceExplainer(mask_bank=tmp_path)
+
+
+def test_distance_explainer_mask_cache(dummy_data: tuple[ArrayLike, ArrayLike], dummy_model: Callable):
+    """Masks should be generated once per set of explainer parameters and then come from the cache."""
+    embedded_reference, input_arr = dummy_data
+    mask_cache = MaskCache(max_bytes=10 ** 6)
+    explainer = DistanceExplainer(n_masks=20, axis_labels={2: 'channels'}, seed=0, mask_cache=mask_cache)
+
+    explainer.explain_image_distance(dummy_model, input_arr, embedded_reference)
+    first_masks = explainer.masks
+    explainer.explain_image_distance(dummy_model, input_arr, embedded_reference)
+
+    assert explainer.masks is first_masks
+    assert not explainer.masks.flags.writeable
+    assert (mask_cache.hits, mask_cache.misses) == (1, 1)
+
+
+def test_mask_cache_evicts_least_recently_used():
+    """The cache should stay within its byte budget by evicting the least recently used masks."""
+    mask_cache = MaskCache(max_bytes=2 * 800)
+    mask_cache.get_or_create('a', lambda: np.zeros(100))
+    mask_cache.get_or_create('b', lambda: np.zeros(100))
+    mask_cache.get_or_create('a', lambda: np.zeros(100))
+    mask_cache.get_or_create('c', lambda: np.zeros(100))
+    mask_cache.get_or_create('d', lambda: np.zeros(1000))  # too large to cache
+
+    assert mask_cache.nbytes <= mask_cache.max_bytes
+    assert list(mask_cache._masks) == ['a', 'c']
+    assert (mask_cache.hits, mask_cache.misses) == (1, 4)
+
+
+def test_distance_explainer_explain_images_distance(dummy_data: tuple[ArrayLike, ArrayLike]):
+    """Explaining a batch of images should give the same maps as explaining the images one by one, with equal masks."""
+    embedded_reference, input_arr = dummy_data
+    images = np.stack([input_arr, input_arr[::-1], input_arr[:, ::-1]])
+    embedded_references = np.stack([embedded_reference, -embedded_reference, embedded_reference ** 2])
+    config = dataclasses.replace(get_default_config(), number_of_masks=25)
+    batch_explainer = get_explainer(config)
+    batch_explainer.batch_size = 7  # batches contain masked versions of more than one image
+
+    saliency = batch_explainer.explain_images_distance(deterministic_model, images, embedded_references)
+
+    assert saliency.shape == (3, 1) + input_arr.shape[:2] + (1,)
+    assert batch_explainer.predictions.shape == (3, 25, DUMMY_EMBEDDING_DIMENSIONALITY)
+    for image, reference, image_saliency in zip(images, embedded_references, saliency):
+        explainer = get_explainer(config)
+        expected_saliency = explainer.explain_image_distance(deterministic_model, image, reference,
+                                                             masks=batch_explainer.masks)
+        assert np.allclose(expected_saliency, image_saliency)
+
+
+def test_distance_explainer_multiple_references(dummy_data: tuple[ArrayLike, ArrayLike]):
+    """A matrix of references should give one map per reference, equal to explaining each reference separately."""
+    embedded_reference, input_arr = dummy_data
+    embedded_references = np.random.randn(4, DUMMY_EMBEDDING_DIMENSIONALITY)
+    config = dataclasses.replace(get_default_config(), number_of_masks=50)
+    explainer = get_explainer(config)
+
+    saliency = explainer.explain_image_distance(deterministic_model, input_arr, embedded_references)
+
+    assert saliency.shape == (4,) + input_arr.shape[:2] + (1,)
+    for reference, reference_saliency in zip(embedded_references, saliency):
+        expected_saliency = get_explainer(config).explain_image_distance(deterministic_model, input_arr, reference,
+                                                                         masks=explainer.masks)
+        assert np.allclose(expected_saliency[0], reference_saliency, atol=1e-6)
+
+
+def test_distance_explainer_weighted_selection(dummy_data: tuple[ArrayLike, ArrayLike]):
+    """With weighted selection, the map should be the exp(-distance) weighted mean of the selected masks."""
+    embedded_reference, input_arr = dummy_data
+    explainer = get_explainer(dataclasses.replace(get_default_config(), number_of_masks=50))
+    explainer.weighted_selection = True
+
+    saliency = explainer.explain_image_distance(deterministic_model, input_arr, embedded_reference)
+
+    distances = explainer.calculate_distances(explainer.predictions, embedded_reference[None])[:, 0]
+    order = np.argsort(distances)
+    lowest, highest = order[:5], order[45:]
+    expected_saliency = (np.average(explainer.masks[lowest], axis=0, weights=np.exp(-distances[lowest]))
+                         - np.average(explainer.masks[highest], axis=0, weights=np.exp(-distances[highest])))
+    assert np.allclose(expected_saliency, saliency[0], atol=1e-6)
+    # the statistics describe the exp(-distance) weights before normalization
+    assert f'max:{np.max(np.exp(-distances[lowest]))}' in explainer.statistics
+
+
+def test_distance_explainer_stops_when_converged(dummy_data: tuple[ArrayLike, ArrayLike]):
+    """With a convergence threshold, the explainer should stop before using all masks once the map is stable."""
+    embedded_reference, input_arr = dummy_data
+    explainer = get_explainer(dataclasses.replace(get_default_config(), number_of_masks=2000))
+    explainer.convergence_threshold = 0.5
+    calls = []
+
+    def counting_model(x):
+        calls.append(len(x))
+        return deterministic_model(x)
+
+    saliency = explainer.explain_image_distance(counting_model, input_arr, embedded_reference)
+
+    assert explainer.n_masks_used < 2000
+    assert explainer.n_masks_used % explainer.convergence_interval == 0
+    assert sum(calls) == explainer.n_masks_used
+    assert len(explainer.predictions) == len(explainer.masks) == explainer.n_masks_used
+    expected_saliency = get_explainer(dataclasses.replace(get_default_config(), number_of_masks=explainer.n_masks_used)
+                                      ).explain_image_distance(deterministic_model, input_arr, embedded_reference,
+                                                               masks=explainer.masks)
+    assert np.allclose(expected_saliency, saliency)
+
+
+def test_distance_explainer_iter_explain(dummy_data: tuple[ArrayLike, ArrayLike]):
+    """Intermediate maps should be yielded every few batches, and the last map should be the full explanation."""
+    embedded_reference, input_arr = dummy_data
+    config = dataclasses.replace(get_default_config(), number_of_masks=95)
+    explainer = get_explainer(config)
+
+    n_masks_used = []
+    for saliency in explainer.iter_explain_image_distance(deterministic_model, input_arr, embedded_reference,
+                                                          yield_every=3):
+        assert saliency.shape == (1,) + input_arr.shape[:2] + (1,)
+        n_masks_used.append(explainer.n_masks_used)
+
+    assert n_masks_used == [30, 60, 90, 95]
+    expected_saliency = get_explainer(config).explain_image_distance(deterministic_model, input_arr,
+                                                                     embedded_reference, masks=explainer.masks)
+    assert np.array_equal(expected_saliency, saliency)
+
+
+def test_distance_explainer_embedding_cache(dummy_data: tuple[ArrayLike, ArrayLike], tmp_path):
+    """Explaining the same image with the same masks again should restore the predictions from the cache."""
+    embedded_reference, input_arr = dummy_data
+    calls = []
+
+    def counting_model(x):
+        calls.append(len(x))
+        return deterministic_model(x).astype(np.float32)
+
+    def explain(explainer, image):
+        return explainer.explain_image_distance(counting_model, image, embedded_reference)
+
+    explainer = DistanceExplainer(n_masks=30, axis_labels={2: 'channels'}, seed=0,
+                                  embedding_cache=tmp_path / 'embeddings.sqlite')
+    expected_saliency = explain(explainer, input_arr)
+    explainer.mask_selection_range_max = 0.5
+    explain(explainer, input_arr)
+    assert sum(calls) == 30
+
+    saliency = explain(DistanceExplainer(n_masks=30, axis_labels={2: 'channels'}, seed=0,
+                                         embedding_cache=EmbeddingCache(tmp_path / 'embeddings.sqlite')), input_arr)
+    assert sum(calls) == 30
+    assert np.array_equal(expected_saliency, saliency)
+
+    explain(explainer, input_arr[::-1])  # other image
+    assert sum(calls) == 60
+
+    # identical bytes in another shape, with user specified masks that are identified by content only
+    masks = explainer.masks.reshape(30, 16, 64, 1)
+    explainer.explain_image_distance(counting_model, np.ascontiguousarray(input_arr).reshape(16, 64, 3),
+                                     embedded_reference, masks=masks)
+    explainer.explain_image_distance(counting_model, np.ascontiguousarray(input_arr).reshape(64, 16, 3),
+                                     embedded_reference, masks=masks.reshape(30, 64, 16, 1))
+    assert sum(calls) == 120
+
+
+def test_distance_explainer_embedding_cache_iterative(dummy_data: tuple[ArrayLike, ArrayLike], tmp_path):
+    """Iterative explanations should use the embedding cache, converging explanations cannot use it at all."""
+    embedded_reference, input_arr = dummy_data
+    calls = []
+
+    def counting_model(x):
+        calls.append(len(x))
+        return deterministic_model(x)
+
+    explainer = DistanceExplainer(n_masks=30, axis_labels={2: 'channels'}, seed=0,
+                                  embedding_cache=tmp_path / 'embeddings.sqlite')
+    *intermediate_saliency, expected_saliency = explainer.iter_explain_image_distance(counting_model, input_arr,
+                                                                                      embedded_reference,
+                                                                                      yield_every=1)
+    assert len(intermediate_saliency) == 2
+    assert sum(calls) == 30
+
+    cached_saliency = list(explainer.iter_explain_image_distance(counting_model, input_arr, embedded_reference))
+    assert sum(calls) == 30
+    assert len(cached_saliency) == 1
+    assert np.array_equal(expected_saliency, cached_saliency[0])
+    assert np.array_equal(expected_saliency, explainer.explain_image_distance(counting_model, input_arr,
+                                                                              embedded_reference))
+    assert sum(calls) == 30
+
+    with pytest.raises(ValueError, match="convergence_threshold"):
+        DistanceExplainer(embedding_cache=tmp_path / 'embeddings.sqlite', convergence_threshold=0.9)
+
+
+@pytest.mark.parametrize("include_masks", [True, False])
+def test_distance_explainer_recompute_from_saved_predictions(dummy_data: tuple[ArrayLike, ArrayLike], tmp_path,
+                                                             include_masks: bool):
+    """Saved predictions should give the same attribution as a full explanation, for any selection range."""
+    embedded_reference, input_arr = dummy_data
+    explainer = DistanceExplainer(n_masks=40, axis_labels={2: 'channels'}, seed=0)
+    explainer.explain_image_distance(deterministic_model, input_arr, embedded_reference)
+    explainer.save_predictions(tmp_path / 'predictions.npz', include_masks=include_masks)
+
+    loading_explainer = DistanceExplainer(n_masks=40, axis_labels={2: 'channels'}, seed=0)
+    loading_explainer.load_predictions(tmp_path / 'predictions.npz')
+    saliency = loading_explainer.recompute_attribution(-embedded_reference, mask_selection_range_max=0.5)
+
+    expected_saliency = DistanceExplainer(n_masks=40, axis_labels={2: 'channels'}, seed=0,
+                                          mask_selection_range_max=0.5).explain_image_distance(
+        deterministic_model, input_arr, -embedded_reference)
+    assert loading_explainer.input_shape == input_arr.shape
+    assert np.array_equal(expected_saliency, saliency)
+
+
+def test_distance_explainer_load_predictions_requires_matching_masks(dummy_data: tuple[ArrayLike, ArrayLike],
+                                                                     tmp_path):
+    """Predictions saved without masks cannot be loaded by an explainer that generates other masks."""
+    embedded_reference, input_arr = dummy_data
+    explainer = DistanceExplainer(n_masks=40, axis_labels={2: 'channels'}, seed=0)
+    explainer.explain_image_distance(deterministic_model, input_arr, embedded_reference)
+    explainer.save_predictions(tmp_path / 'predictions.npz', include_masks=False)
+
+    with pytest.raises(ValueError):
+        DistanceExplainer(n_masks=40, axis_labels={2: 'channels'}, seed=1).load_predictions(
+            tmp_path / 'predictions.npz')
+
+
+def test_distance_explainer_rejects_predictions_of_image_batches(dummy_data: tuple[ArrayLike, ArrayLike],
+                                                                  tmp_path):
+    """Predictions of a batch of images, or more predictions than masks, cannot be recomputed, saved or loaded."""
+    embedded_reference, input_arr = dummy_data
+    explainer = DistanceExplainer(n_masks=40, axis_labels={2: 'channels'}, seed=0)
+    explainer.explain_images_distance(deterministic_model, np.stack([input_arr, input_arr]),
+                                      np.stack([embedded_reference, embedded_reference]))
+
+    with pytest.raises(ValueError, match="explain_images_distance"):
+        explainer.recompute_attribution(embedded_reference)
+    with pytest.raises(ValueError, match="explain_images_distance"):
+        explainer.save_predictions(tmp_path / 'predictions.npz')
+
+    np.savez(tmp_path / 'too_many.npz', predictions=np.zeros((41, DUMMY_EMBEDDING_DIMENSIONALITY)),
+             input_shape=input_arr.shape, masks_id='', masks=explainer.masks)
+    with pytest.raises(ValueError, match="more saved predictions"):
+        explainer.load_predictions(tmp_path / 'too_many.npz')
+
+
+def test_distance_explainer_auto_batch_size(dummy_data: tuple[ArrayLike, ArrayLike]):
+    """A model with a large overhead per call should get the largest batch size that fits in the memory budget."""
+    embedded_reference, input_arr = dummy_data
+    masked_input_nbytes = input_arr.nbytes
+    prediction_nbytes = DUMMY_EMBEDDING_DIMENSIONALITY * 8
+    explainer = DistanceExplainer(n_masks=200, axis_labels={2: 'channels'}, batch_size='auto',
+                                  max_batch_bytes=16 * (2 * masked_input_nbytes + prediction_nbytes))
+
+    def slow_model(x):
+        time.sleep(0.01)
+        return deterministic_model(x)
+
+    explainer.explain_image_distance(slow_model, input_arr, embedded_reference)
+
+    assert explainer.tuned_batch_size == 16
+    assert len(explainer.predictions) == 200
+
+
+def test_distance_explainer_prefetch_identical(dummy_data: tuple[ArrayLike, ArrayLike]):
+    """Preparing batches on a background thread should give exactly the same predictions."""
+    embedded_reference, input_arr = dummy_data
+    preprocess_threads = set()
+
+    def preprocess_function(x):
+        preprocess_threads.add(threading.get_ident())
+        return x * 2
+
+    config = dataclasses.replace(get_default_config(), number_of_masks=95)
+    explainer = get_explainer(config, preprocess_function=preprocess_function)
+    prefetching_explainer = get_explainer(config, preprocess_function=preprocess_function)
+    prefetching_explainer.prefetch = True
+
+    explainer.explain_image_distance(deterministic_model, input_arr, embedded_reference)
+    assert preprocess_threads == {threading.get_ident()}
+    prefetching_explainer.explain_image_distance(deterministic_model, input_arr, embedded_reference,
+                                                 masks=explainer.masks)
+
+    assert len(preprocess_threads) == 2
+    assert np.array_equal(explainer.predictions, prefetching_explainer.predictions)
+
+
+def test_distance_explainer_channels_first_model_input(dummy_data: tuple[ArrayLike, ArrayLike]):
+    """The model should get plain numpy batches of masked inputs with the channels axis where it was in the input."""
+    embedded_reference, input_arr = dummy_data
+    channels_first_input = np.moveaxis(input_arr, -1, 0)
+    model_inputs = []
+
+    def recording_model(x):
+        model_inputs.append(x.copy())
+        return deterministic_model(x)
+
+    explainer = get_explainer(dataclasses.replace(get_default_config(), number_of_masks=25),
+                              axis_labels={0: 'channels'})
+    explainer.explain_image_distance(recording_model, channels_first_input, embedded_reference)
+
+    assert all(type(model_input) is np.ndarray for model_input in model_inputs)
+    expected_model_input = channels_first_input[None] * np.moveaxis(explainer.masks, -1, 1)
+    assert np.array_equal(expected_model_input, np.concatenate(model_inputs))
+
+
+@pytest.mark.parametrize("dtype,atol", [(np.float32, 1e-6), (np.float16, 1e-3)])
+def test_distance_explainer_dtype_saliency(dummy_data: tuple[ArrayLike, ArrayLike], dummy_model: Callable,
+                                           dtype, atol: float):
+    """Reduced precision should agree with the recorded float64 saliency, which selects the same masks."""
+    embedded_reference, input_arr = dummy_data
+    expected_saliency, expected_value = np.load('./tests/test_data/test_dummy_data_exact_expected_output.npz').values()
+    explainer = get_explainer(get_default_config())
+    explainer.dtype = np.dtype(dtype)
+    model_inputs = []
+
+    def recording_model(x):
+        model_inputs.append(x)
+        return dummy_model(x)
+
+    saliency = explainer.explain_image_distance(recording_model, input_arr, embedded_reference)
+
+    assert explainer.masks.dtype == dtype
+    assert saliency.dtype == np.float32
+    assert all(model_input.dtype == input_arr.dtype for model_input in model_inputs)
+    assert np.allclose(expected_saliency, saliency, atol=atol)
+
+
+@pytest.mark.parametrize("dtype,atol", [(np.float32, 1e-6), (np.float16, 1e-3)])
+def test_distance_explainer_dtype_saliency_input_dependent_model(dummy_data: tuple[ArrayLike, ArrayLike], dtype,
+                                                                 atol: float):
+    """Reduced precision maps should be within the tolerance of the full precision map of the masks they select.
+
+    Rounded inputs can reorder the distances, so with a model that depends on its input, these are not always the masks
+    that are selected in full precision.
+    """
+    embedded_reference, input_arr = dummy_data
+    config = dataclasses.replace(get_default_config(), number_of_masks=95)
+    explainer = get_explainer(config)
+    expected_saliency = explainer.explain_image_distance(deterministic_model, input_arr, embedded_reference)
+    reduced_explainer = get_explainer(config)
+    reduced_explainer.dtype = np.dtype(dtype)
+
+    saliency = reduced_explainer.explain_image_distance(deterministic_model, input_arr, embedded_reference,
+                                                        masks=explainer.masks)
+
+    distances = reduced_explainer.calculate_distances(reduced_explainer.predictions, embedded_reference[None])
+    order = np.argsort(distances[:, 0], kind='stable')
+    lowest = order[int(95 * config.mask_selection_range_min):int(95 * config.mask_selection_range_max)]
+    highest = order[int(95 * config.mask_selection_negative_range_min):
+                    int(95 * config.mask_selection_negative_range_max)]
+    assert np.allclose(explainer.masks[lowest].mean(axis=0) - explainer.masks[highest].mean(axis=0), saliency[0],
+                       atol=atol)
+    if dtype == np.float32:
+        assert np.allclose(expected_saliency, saliency, atol=atol)
+
+
+def _reference_distance(metric, prediction, reference, inverse_covariance):
+    """Distance between two points, straight from the definition of the metric."""
+    cosine_similarity = prediction @ reference / (np.linalg.norm(prediction) * np.linalg.norm(reference))
+    difference = prediction - reference
+    return {'cosine': (1 - cosine_similarity) / 2,
+            'angular': np.arccos(np.clip(cosine_similarity, -1, 1)) / np.pi,
+            'euclidean': np.linalg.norm(difference),
+            'sqeuclidean': difference @ difference,
+            'dot': -prediction @ reference,
+            'mahalanobis': np.sqrt(difference @ inverse_covariance @ difference)}[metric]
+
+
+@pytest.mark.parametrize("metric", ['cosine', 'angular', 'euclidean', 'sqeuclidean', 'dot', 'mahalanobis'])
+def test_calculate_distances_metrics(metric: str):
+    """Every metric should match its definition, for every combination of prediction and reference."""
+    rng = np.random.default_rng(0)
+    predictions = rng.normal(size=(30, 6))
+    references = rng.normal(size=(3, 6))
+    factor = rng.normal(size=(6, 6))
+    inverse_covariance = factor @ factor.T + np.eye(6)
+    distance_metric = MahalanobisDistance(inverse_covariance) if metric == 'mahalanobis' else metric
+
+    distances = DistanceExplainer.calculate_distances(predictions, references, distance_metric)
+
+    expected_distances = [[_reference_distance(metric, prediction, reference, inverse_covariance)
+                           for reference in references] for prediction in predictions]
+    assert np.allclose(expected_distances, distances)
+    with pytest.raises(ValueError, match="Unknown distance metric"):
+        DistanceExplainer(distance_metric='manhattan')
+    with pytest.raises(ValueError, match="MahalanobisDistance"):
+        DistanceExplainer(distance_metric='mahalanobis')
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_cosine_distance_chunks(dtype):
+    """Chunked cosine distances should not depend on the chunk size, and give 0.5 for all-zero predictions."""
+    rng = np.random.default_rng(0)
+    predictions = rng.normal(size=(1000, 7)).astype(dtype)
+    predictions[500] = 0
+    references = rng.normal(size=(2, 7)).astype(dtype)
+
+    distances = CosineDistance(chunk_bytes=64 * predictions[0].nbytes)(predictions, references)
+
+    assert distances.dtype == dtype
+    assert np.allclose(CosineDistance(chunk_bytes=1)(predictions, references), distances)
+    assert np.allclose(CosineDistance(chunk_bytes=predictions.nbytes)(predictions, references), distances)
+    assert np.all(distances[500] == 0.5)
+    assert np.allclose(DistanceExplainer.calculate_distances(predictions.tolist(), references.tolist()),
+                       distances)
+
+
+def test_distance_explainer_without_keeping_predictions(dummy_data: tuple[ArrayLike, ArrayLike]):
+    """Reducing batches to distances as they arrive should give the same maps, without keeping the predictions."""
+    embedded_reference, input_arr = dummy_data
+    config = dataclasses.replace(get_default_config(), number_of_masks=95)
+    explainer = get_explainer(config)
+    expected_saliency = explainer.explain_image_distance(deterministic_model, input_arr, embedded_reference)
+    streaming_explainer = get_explainer(config)
+    streaming_explainer.keep_predictions = False
+
+    def list_model(x):
+        return deterministic_model(x).tolist()
+
+    saliency = streaming_explainer.explain_image_distance(list_model, input_arr, embedded_reference,
+                                                          masks=explainer.masks)
+    *_, last_saliency = streaming_explainer.iter_explain_image_distance(deterministic_model, input_arr,
+                                                                        embedded_reference, masks=explainer.masks)
+
+    assert streaming_explainer.predictions is None
+    assert streaming_explainer.distances.shape == (95, 1)
+    assert np.allclose(explainer.calculate_distances(explainer.predictions, embedded_reference[None]),
+                       streaming_explainer.distances)
+    assert np.allclose(expected_saliency, saliency)
+    assert np.allclose(expected_saliency, last_saliency)
+    with pytest.raises(ValueError, match="embedding cache"):
+        DistanceExplainer(embedding_cache=EmbeddingCache(':memory:'), keep_predictions=False)
+
+
+def test_distance_explainer_predictions_written_into_one_array(dummy_data: tuple[ArrayLike, ArrayLike]):
+    """Batches should be written into one array with the dtype of the model output, instead of being concatenated."""
+    embedded_reference, input_arr = dummy_data
+    explainer = get_explainer(dataclasses.replace(get_default_config(), number_of_masks=95))
+
+    def float32_model(x):
+        return deterministic_model(x).astype(np.float32)
+
+    intermediate_predictions = []
+    for _ in explainer.iter_explain_image_distance(float32_model, input_arr, embedded_reference, yield_every=3):
+        intermediate_predictions.append(explainer.predictions)
+
+    assert [len(predictions) for predictions in intermediate_predictions] == [30, 60, 90, 95]
+    assert all(np.shares_memory(predictions, explainer.predictions) for predictions in intermediate_predictions)
+    assert explainer.predictions.dtype == np.float32
+    assert np.array_equal(float32_model(input_arr[None] * explainer.masks), explainer.predictions)
+
+
+def test_distance_explainer_out_of_core(dummy_data: tuple[ArrayLike, ArrayLike], tmp_path):
+    """Memory-mapped masks and predictions, processed in small chunks, should give the same map as in memory."""
+    embedded_reference, input_arr = dummy_data
+    config = dataclasses.replace(get_default_config(), number_of_masks=95)
+    explainer = get_explainer(config)
+    explainer.seed = 0
+    expected_saliency = explainer.explain_image_distance(deterministic_model, input_arr, embedded_reference)
+    out_of_core_explainer = get_explainer(config)
+    out_of_core_explainer.seed = 0
+    out_of_core_explainer.scratch_dir = str(tmp_path)
+    out_of_core_explainer.max_batch_bytes = 10 * input_arr.shape[0] * input_arr.shape[1] * 4  # chunks of 10 masks
+
+    saliency = out_of_core_explainer.explain_image_distance(deterministic_model, input_arr, embedded_reference)
+
+    assert isinstance(out_of_core_explainer.masks, np.memmap)
+    assert isinstance(out_of_core_explainer.predictions, np.memmap)
+    assert len(os.listdir(tmp_path)) == 2
+    assert np.array_equal(explainer.masks, out_of_core_explainer.masks)
+    assert np.array_equal(explainer.predictions, out_of_core_explainer.predictions)
+    assert np.allclose(expected_saliency, saliency, atol=1e-6)
+    del out_of_core_explainer
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.filterwarnings("ignore:invalid value encountered in subtract")  # std of the overflowing weights
+def test_distance_explainer_weighted_selection_unbounded_metric(dummy_data: tuple[ArrayLike, ArrayLike]):
+    """Weighted selection should not overflow for metrics with large distances, like the dot product."""
+    embedded_reference, input_arr = dummy_data
+    explainer = get_explainer(dataclasses.replace(get_default_config(), number_of_masks=50))
+    explainer.weighted_selection = True
+    explainer.distance_metric = DotProductDistance()
+
+    def large_embedding_model(x):
+        return 100 * deterministic_model(x)
+
+    reference = 100 * np.ones_like(embedded_reference)
+    saliency = explainer.explain_image_distance(large_embedding_model, input_arr, reference)
+
+    distances = -explainer.predictions @ reference
+    order = np.argsort(distances)
+    lowest, highest = order[:5], order[45:]
+    assert np.all(distances[lowest] < -710)  # exp(-distance) overflows float64
+    expected_saliency = (
+        np.average(explainer.masks[lowest], axis=0, weights=np.exp(distances[lowest].min() - distances[lowest]))
+        - np.average(explainer.masks[highest], axis=0, weights=np.exp(distances[highest].min() - distances[highest])))
+    assert np.all(np.isfinite(saliency))
+    assert np.allclose(expected_saliency, saliency[0], atol=1e-6)
+
+
+@pytest.mark.parametrize("n_workers", [0, -1, 1.5])
+def test_distance_explainer_rejects_invalid_n_workers(n_workers):
+    """The number of workers should be checked when the explainer is created, not when the pool is started."""
+    with pytest.raises(ValueError, match="n_workers"):
+        DistanceExplainer(n_workers=n_workers)
+
+
+def test_distance_explainer_auto_batch_size_ignores_one_slow_probe(dummy_data: tuple[ArrayLike, ArrayLike]):
+    """A single slow size, e.g. from timing noise, should not stop the search for a faster, larger batch size."""
+    embedded_reference, input_arr = dummy_data
+    masked_input_nbytes = input_arr.nbytes
+    prediction_nbytes = DUMMY_EMBEDDING_DIMENSIONALITY * 8
+    explainer = DistanceExplainer(n_masks=200, axis_labels={2: 'channels'}, batch_size='auto',
+                                  max_batch_bytes=16 * (2 * masked_input_nbytes + prediction_nbytes))
+
+    def model_with_slow_size(x):
+        time.sleep(0.04 if len(x) == 2 else 0.01)
+        return deterministic_model(x)
+
+    explainer.explain_image_distance(model_with_slow_size, input_arr, embedded_reference)
+
+    assert explainer.tuned_batch_size == 16